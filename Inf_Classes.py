@@ -1,32 +1,25 @@
 #!/usr/bin/env python
 
-import xml.dom.minidom as minidom
-from copy import deepcopy
-from glob import glob
+import xml.sax
+import re
+from array import array
+from glob_cache import expand_patterns
 
 import os
 
 class JobConfig(object):
-    def __init__(self,node):
-        for item in node.attributes.items():
+    def __init__(self,attrs):
+        for item in attrs.items():
             if(item[0]=='JobName'): self.JobName = item[1]
             if(item[0]=='OutputLevel'):  self.OutputLevel = item[1]
         self.Libs = []
-        for child in node.getElementsByTagName('Library'):
-            for lib in child.attributes.items():
-                self.Libs.append(lib[1])
         self.Packs = []
-        for child in node.getElementsByTagName('Package'):
-            for pack in child.attributes.items():
-                self.Packs.append(lib[1])
         self.Job_Cylce = []
-        for item in node.getElementsByTagName('Cycle'):
-            self.Job_Cylce.append(Cycle(item))
 
 class Cycle(object):
-    def __init__(self,node):       
+    def __init__(self,attrs):       
         self.cacheData = 0
-        for item in node.attributes.items():
+        for item in attrs.items():
             if(item[0]=='Name'): self.Cyclename = item[1]
             #if(item[0]=='RunMode'):  self.RunMode = item[1]
             #if(item[0]=='ProofServer'): self.ProofServer = item[1]
@@ -34,31 +27,32 @@ class Cycle(object):
             if(item[0]=='OutputDirectory'): self.OutputDirectory = item[1]
             if(item[0]=='PostFix'):  self.PostFix = item[1]
             if(item[0]=='TargetLumi'):  self.TargetLumi = item[1]
-        
         self.Cycle_InputData =[]
-        for item in node.getElementsByTagName('InputData'):
-            self.Cycle_InputData.append(InputData(item,self.cacheData))
-            if self.Cycle_InputData[-1].Cacheable=='True': self.cacheData = True
-
         self.Cycle_UserConf = []
-        for child in node.getElementsByTagName('UserConfig'):
-            for item in child.getElementsByTagName('Item'):
-                name =  None
-                value = None
-                for attr in item.attributes.items():
-                    if(attr[0]=='Name'): name=attr[1]
-                    if(attr[0]=='Value'): value=attr[1]
-                self.Cycle_UserConf.append(UserConfig(name,value))
 
+    def add_InputData(self,inputdata):
+        self.Cycle_InputData.append(inputdata)
+        if inputdata.Cacheable=='True': self.cacheData = True
+
+    def add_UserConfig(self,attrs):
+        name =  None
+        value = None
+        for attr in attrs.items():
+            if(attr[0]=='Name'): name=attr[1]
+            if(attr[0]=='Value'): value=attr[1]
+        self.Cycle_UserConf.append(UserConfig(name,value))
+
+    #called once the whole cycle is read
+    def finish(self):
         #print self.Cycle_UserConf
         UC_sframe_weight = filter(lambda uc: uc.Name == 'use_sframe_weight', self.Cycle_UserConf)
         self.usingSFrameWeight = not (UC_sframe_weight and UC_sframe_weight[0].Value == 'false')
 
 
 class InputData(object):
-    def __init__(self,node,cacheMe):
+    def __init__(self,attrs,cacheMe):
         self.NEventsSkip = 0        
-        for item in node.attributes.items():
+        for item in attrs.items():
             if ' ' in item[1]:
                 print 'Space in',item[0],'=',item[1]
                 print 'Aborting since this is most probably wrong'
@@ -77,30 +71,43 @@ class InputData(object):
             if(item[0]=='NEventsSkip'): self.NEventsSkip = item[1]
         #print self.Version
         self.io_list =InputList()
-        for item in node.childNodes:
-            #print item.nodeValue
-            if not item.nodeType == 3:
-                help_list = []
-                #print item.nodeName
-                help_list.append(item.nodeName)
-                for entry in item.attributes.items():
-                    for y in entry:
-                        help_list.append(y)
-                if item.nodeName == "In":
-                    self.io_list.FileInfoList.append(help_list)
-                elif item.nodeName == "InputTree":
-                    if len(self.io_list.InputTree)==0: 
-                        self.io_list.InputTree=help_list
-                    elif self.io_list.InputTree != help_list:
-                        print 'not using the same InputTree. Prefere to exit'
-                        exit(0)
-                else:
-                    self.io_list.other.append(help_list)
-            
-                
-        expanded_list = []
+        self.FilePatterns = [] # wildcards used for the file names, needed to know when the config is outdated
+        self.lastFile = None # file of the last In, a comment right after it can give its number of entries
+
+    #direct children of the InputData node, the files are added one by one while the config is read
+    def add_child(self,name,attrs):
+        help_list = [name]
+        for entry in attrs.items():
+            for y in entry:
+                help_list.append(y)
+        self.lastFile = None
+        if name == "In":
+            self.FilePatterns += filter(lambda s: '*' in s, help_list)
+            self.io_list.FileInfoList.append(help_list)
+            if 'FileName' in help_list: self.lastFile = help_list[help_list.index('FileName')+1]
+        elif name == "InputTree":
+            if len(self.io_list.InputTree)==0: 
+                self.io_list.InputTree=help_list
+            elif self.io_list.InputTree != help_list:
+                print 'not using the same InputTree. Prefere to exit'
+                exit(0)
+        else:
+            self.io_list.other.append(help_list)
+
+    #<!-- NEntries="n" --> after an In, as written into Result.xml, saves opening the file to count its entries
+    def add_comment(self,content):
+        match = NENTRIES.search(content)
+        if match and self.lastFile:
+            self.io_list.Entries[self.lastFile] = int(match.group(1))
+
+    #called once all children are read, expands the wildcards in the file names
+    def finish(self):
+        if not self.FilePatterns:
+            return
+        expanded = expand_patterns(self.FilePatterns) # one listing per directory for all patterns
+        expanded_list = CompactFileList()
         for help_list in self.io_list.FileInfoList:
-            expanded_list += _expand_help_list_filenames(help_list)
+            expanded_list.extend(_expand_help_list_filenames(help_list,expanded))
         self.io_list.FileInfoList = expanded_list
 
     def split_NEvents(self,NEventsBreak,LastBreak):
@@ -108,6 +115,8 @@ class InputData(object):
         self.LastBreak = LastBreak   
         
     
+NENTRIES = re.compile(r'NEntries="(\d+)"')
+
 class UserConfig(object):
     def __init__(self,Name,Value):
         self.Name = Name
@@ -115,23 +124,209 @@ class UserConfig(object):
 
 class InputList(object):
     def __init__(self):
-        self.FileInfoList =[]
+        self.FileInfoList = CompactFileList()
         self.InputTree = []
         self.other =[]
+        self.Entries = {} # file name -> number of entries, for files that came with it
+
+
+#tables shared by a CompactFileList and all slices taken from it, entries are only ever appended
+class _FileTables(object):
+    def __init__(self):
+        self.schemas = [] # node name and attribute names
+        self.filePos = [] # position of FileName in the attributes of each schema, -1 if there is none
+        self.dirs = []
+        self.values = [] # all attribute values apart from FileName
+        self.lookup = {}
+
+    def index(self,table,key):
+        pos = self.lookup.get((table,key))
+        if pos is None:
+            if table == 's':
+                pos = len(self.schemas)
+                self.schemas.append(key)
+                self.filePos.append(key.index('FileName')-1 if 'FileName' in key else -1)
+            elif table == 'd':
+                pos = len(self.dirs)
+                self.dirs.append(key)
+            else:
+                pos = len(self.values)
+                self.values.append(key)
+            self.lookup[(table,key)] = pos
+        return pos
+
+#Replacement for a list of ['In','FileName',name,'Lumi',lumi] lists.
+#The node and attribute names are stored once, the directories of the file names once
+#and only the base names per file. Slices share the tables and are cheap to make and copy.
+class CompactFileList(object):
+    def __init__(self,entries=[],tables=None):
+        self.tables = tables if tables else _FileTables()
+        self.schemaIndex = array('i')
+        self.dirIndex = array('i')
+        self.valueIndex = array('i')
+        self.basenames = []
+        self.extend(entries)
+
+    def append(self,entry):
+        schema = tuple([entry[0]]+entry[1::2])
+        values = entry[2::2]
+        schemaPos = self.tables.index('s',schema)
+        filePos = self.tables.filePos[schemaPos]
+        directory = ''
+        basename = ''
+        if filePos >= 0:
+            filename = values.pop(filePos)
+            directory = filename[:filename.rfind('/')+1]
+            basename = filename[len(directory):]
+        self.schemaIndex.append(schemaPos)
+        self.dirIndex.append(self.tables.index('d',directory))
+        self.valueIndex.append(self.tables.index('v',tuple(values)))
+        self.basenames.append(basename)
+
+    def extend(self,entries):
+        for entry in entries:
+            self.append(entry)
+
+    def filename(self,i):
+        return self.tables.dirs[self.dirIndex[i]]+self.basenames[i]
+
+    def _entry(self,i):
+        schemaPos = self.schemaIndex[i]
+        schema = self.tables.schemas[schemaPos]
+        values = list(self.tables.values[self.valueIndex[i]])
+        if self.tables.filePos[schemaPos] >= 0:
+            values.insert(self.tables.filePos[schemaPos],self.filename(i))
+        entry = [schema[0]]
+        for name,value in zip(schema[1:],values):
+            entry += [name,value]
+        return entry
+
+    def __len__(self):
+        return len(self.basenames)
+
+    def __iter__(self):
+        for i in xrange(len(self.basenames)):
+            yield self._entry(i)
+
+    def __getitem__(self,i):
+        if isinstance(i,slice):
+            new_list = CompactFileList(tables=self.tables)
+            new_list.schemaIndex = self.schemaIndex[i]
+            new_list.dirIndex = self.dirIndex[i]
+            new_list.valueIndex = self.valueIndex[i]
+            new_list.basenames = self.basenames[i]
+            return new_list
+        if i < 0: i += len(self.basenames)
+        if i < 0 or i >= len(self.basenames):
+            raise IndexError('CompactFileList index out of range')
+        return self._entry(i)
+
+    def __delitem__(self,i):
+        del self.schemaIndex[i]
+        del self.dirIndex[i]
+        del self.valueIndex[i]
+        del self.basenames[i]
+
+    def remove(self,entry):
+        for i in xrange(len(self.basenames)):
+            if self._entry(i) == entry:
+                del self[i]
+                return
+        raise ValueError('CompactFileList.remove(x): x not in list')
+
+    def remove_indices(self,indices):
+        for i in sorted(set(indices),reverse=True):
+            del self[i]
+
+    #the strings are never changed, so only the index arrays need to be copied
+    def __copy__(self):
+        return self[:]
+
+    def __deepcopy__(self,memo):
+        return self[:]
+
+#builds the JobConfig while the xml file is read, no DOM of the whole file is kept in memory
+class JobConfigHandler(xml.sax.handler.ContentHandler):
+    def __init__(self,versions=None):
+        xml.sax.handler.ContentHandler.__init__(self)
+        self.versions = versions # only InputData with one of these versions is kept, all if None
+        self.Job = None
+        self.cycle = None
+        self.inputdata = None
+        self.depth = 0 # depth of the current node, children of InputData are one below it
+        self.inputdataDepth = -1
+        self.userConf = False
+
+    def startElement(self,name,attrs):
+        self.depth += 1
+        if self.inputdata and self.depth == self.inputdataDepth+1:
+            self.inputdata.add_child(name,attrs)
+        elif name == 'JobConfiguration':
+            self.Job = JobConfig(attrs)
+        elif name == 'Library':
+            for lib in attrs.items():
+                self.Job.Libs.append(lib[1])
+        elif name == 'Package':
+            for pack in attrs.items():
+                self.Job.Packs.append(pack[1])
+        elif name == 'Cycle':
+            self.cycle = Cycle(attrs)
+        elif name == 'InputData' and self.cycle:
+            self.inputdata = InputData(attrs,self.cycle.cacheData)
+            self.inputdataDepth = self.depth
+        elif name == 'UserConfig' and self.cycle:
+            self.userConf = True
+        elif name == 'Item' and self.userConf:
+            self.cycle.add_UserConfig(attrs)
+
+    #lexical handler, only the comments are of interest
+    def comment(self,content):
+        if self.inputdata and self.depth == self.inputdataDepth:
+            self.inputdata.add_comment(content)
+
+    def startDTD(self,name,publicId,systemId): pass
+    def endDTD(self): pass
+    def startCDATA(self): pass
+    def endCDATA(self): pass
+
+    def endElement(self,name):
+        if self.inputdata and self.depth == self.inputdataDepth:
+            if self.versions is None or self.inputdata.Version in self.versions:
+                self.inputdata.finish()
+                self.cycle.add_InputData(self.inputdata)
+            self.inputdata = None
+        elif name == 'UserConfig':
+            self.userConf = False
+        elif name == 'Cycle' and self.cycle:
+            self.cycle.finish()
+            self.Job.Job_Cylce.append(self.cycle)
+            self.cycle = None
+        self.depth -= 1
+
+#entities are read directly from the SYSTEM files, the dtd itself is not needed.
+#With versions only these InputData are read, the wildcards of the others are not expanded
+def parse_jobconfig(xmlfile,versions=None):
+    handler = JobConfigHandler(versions)
+    sax_parser = xml.sax.make_parser()
+    sax_parser.setFeature(xml.sax.handler.feature_external_ges,True)
+    sax_parser.setContentHandler(handler)
+    sax_parser.setProperty(xml.sax.handler.property_lexical_handler,handler)
+    sax_parser.parse(xmlfile)
+    return handler.Job
 
 
-def _expand_help_list_filenames(help_list):
+def _expand_help_list_filenames(help_list,expanded):
     filenames = filter(lambda s: '*' in s, help_list)
     if not filenames:
         return [help_list]
     assert(len(filenames) == 1)
     pattern = filenames[0]
-    real_filenames = glob(pattern)
+    real_filenames = expanded[pattern]
     if not real_filenames:
         raise RuntimeError('No files found for pattern: %s'%pattern)
     new_help_list = []
     for new_file in real_filenames:
-        new_list = deepcopy(help_list)
+        new_list = list(help_list)
         new_help_list.append(new_list)
         for i in xrange(len(new_list)):
             if new_list[i] == pattern:
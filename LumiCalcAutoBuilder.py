@@ -6,7 +6,8 @@ import ConfigParser
 # Keep this in mind if it need to be updated some day
 import readaMCatNloEntries
 
-import sys, glob, copy, os, re
+import sys, os, re
+from glob_cache import cached_glob
 # From a list of CrossSections and XML Files this class creates the sframe steering file!
 # Lets see how complicated this can get ???  
 
@@ -30,6 +31,9 @@ class lumicalc_autobuilder(object):
         self.ProcessList = []
         finished_samples = False
         self.UserConfigText = []
+        pending = [] # [name, cross section, xml file, number of events or (xml file, fast) if they still have to be counted]
+        toCount = [] # (xml file, fast), all counted together at the end with one pool
+        workers = 1
         with open(str(path_to_Data)) as f:
             for line in f:
                 if '#' in line or line == '\n' :
@@ -45,8 +49,8 @@ class lumicalc_autobuilder(object):
                 tmpsplit = line.split()
                 if not tmpsplit:continue
 
-                for exp in glob.glob(tmpsplit[1]):
-                    list_process = copy.deepcopy(tmpsplit)
+                for exp in cached_glob(tmpsplit[1]):
+                    list_process = list(tmpsplit)
                     print list_process
                     currentfile = ''
                     if '*' in tmpsplit[1]:
@@ -60,7 +64,7 @@ class lumicalc_autobuilder(object):
 
                     #print list_process
                     if 'data' in list_process[0].lower():
-                        self.ProcessList.append(process_helper(list_process[0],1,list_process[1],1))
+                        pending.append([list_process[0],1,list_process[1],1])
                         continue
                     numberEvents = 0
                     lastxmlline = ''
@@ -82,13 +86,11 @@ class lumicalc_autobuilder(object):
                                 print "for",list_process[0]
                                 exit(1)
                         if len(list_process) > 4:
-                            methodname = 'fast'
-                            if not str2bool(list_process[4]): methodname = 'weights' 
                             print 'going to count events for',list_process[0]
-                            numberEvents = readaMCatNloEntries.readEntries(int(list_process[3]),[list_process[1]],str2bool(list_process[4]))[0]
-                            
-                            with open(list_process[2], "a") as myfile:
-                                myfile.write('<!-- NumberEntries="'+str(numberEvents)+'" Method="'+str(methodname)+'" -->')
+                            numberEvents = (list_process[1],str2bool(list_process[4]))
+                            workers = max(workers,int(list_process[3]))
+                            if numberEvents not in toCount:
+                                toCount.append(numberEvents)
                     else:
                         if len(list_process) == 4: 
                             numberEvents = float(list_process[3])
@@ -108,7 +110,22 @@ class lumicalc_autobuilder(object):
                         for num in numbers:
                             #print num
                             crosssectionNumber = float(crosssectionNumber)*float(num)
-                    self.ProcessList.append(process_helper(list_process[0],crosssectionNumber,list_process[1],numberEvents))
+                    pending.append([list_process[0],crosssectionNumber,list_process[1],numberEvents])
+
+        #one pool for all samples, each counted file is kept in the checkpoint in case the counting gets interrupted
+        checkpoint = str(path_to_Data)+'.entries_checkpoint'
+        if toCount:
+            counts = readaMCatNloEntries.count_entries(workers,toCount,checkpoint)
+            for (xml,fast), numberEvents in zip(toCount,counts):
+                print "number of events in",xml,numberEvents
+                readaMCatNloEntries.write_xml_entry_tag(xml,numberEvents,fast)
+            counted = dict(zip(toCount,counts))
+            for process in pending:
+                if isinstance(process[3],tuple):
+                    process[3] = counted[process[3]]
+            if os.path.exists(checkpoint): os.remove(checkpoint)
+        for name, crosssection, xml, numberEvents in pending:
+            self.ProcessList.append(process_helper(name,crosssection,xml,numberEvents))
                          
                 
         # Follows sframe conventions as of 2016
@@ -14,9 +14,16 @@ import json
 import time
 import gc
 
-import StringIO
-from xml.dom.minidom import parse, parseString
-import xml.sax
+import xml.etree.cElementTree as ElementTree
+from qstat_cache import qstat_snapshot
+from log_triage import LogIndex
+from job_status import statusWatcher
+from memo_store import *
+
+SPECULATE_MIN_DONE = 5 # finished jobs of a process needed before its slow jobs are copied
+QSTAT_RETRY = 60 # seconds before qstat is tried again after it failed
+ACCOUNT_RETRY = 120 # seconds before qacct is asked again for a job it had no record of
+ACCOUNT_TRIES = 10 # qacct calls for a job before it is given up
 
 # takes care of looking into qstat 
 class pidWatcher(object):
@@ -24,29 +31,23 @@ class pidWatcher(object):
         self.pidList = []
         self.taskList = []
         self.stateList = []
+        self.killed = set() # jobs sent to qdel after this snapshot was taken
         try:
-            proc_qstat = subprocess.Popen(['qstat','-xml'],stdout=subprocess.PIPE)
-            qstat_xml =  StringIO.StringIO(proc_qstat.communicate()[0])
-            sax_parser = xml.sax.make_parser()
-            qstat_xml_par = parse(qstat_xml,sax_parser) 
+            #the snapshot is shared with the other sframe_batch of this user on this host
+            qstat_xml_par = ElementTree.fromstring(qstat_snapshot())
             self.parserWorked = True
         except:
             self.pidTaskList = []
             self.parserWorked = False
             print 'Processing qstat information did not work. Maybe the NAF has some problem. Or nothing is running on the Batch anymore.'
-            print 'Going to wait for 5 minutes, lets see if qstat will start to work again.'
-            time.sleep(300)
+            print 'Trying again later, meanwhile only jobs writing heartbeats are followed.'
             return 
 
-        #print qstat_xml_par.toprettyxml()
-        tags = qstat_xml_par.getElementsByTagName("job_list")
-        for jobs in tags:
-            #print jobs.getElementsByTagName("state")[0].firstChild.nodeValue
-            self.pidList.append(jobs.getElementsByTagName("JB_job_number")[0].firstChild.data)
-            self.stateList.append(jobs.getElementsByTagName("state")[0].firstChild.nodeValue)
-            if jobs.getElementsByTagName("tasks"):
-                taskvalue = str(jobs.getElementsByTagName("tasks")[0].firstChild.data)
-                self.taskList.append(taskvalue)
+        for jobs in qstat_xml_par.iter("job_list"):
+            self.pidList.append(jobs.findtext("JB_job_number"))
+            self.stateList.append(jobs.findtext("state"))
+            if jobs.find("tasks") is not None:
+                self.taskList.append(jobs.findtext("tasks"))
             else:
                 self.taskList.append(-1)
 
@@ -63,14 +64,15 @@ class pidWatcher(object):
                 splitted_strings = str(self.taskList[i].split(','))
                 int_list = [splitted_strings[0],splitted_strings[1]]
 
-    def check_pidstatus(self,arraypid,pidlist,task,debug=False):
+    #qstat state of a job or task, '' if it is not in the snapshot and None without any pid
+    def get_state(self,arraypid,pidlist,task,debug=False):
         pid = 0
         if pidlist:
             pid = int(pidlist)
         elif arraypid > 0:
             pid = arraypid
         else:
-            return -1
+            return None
 
         for i in range(len(self.pidList)):
             inrange = False
@@ -82,11 +84,18 @@ class pidWatcher(object):
             if debug and str(self.pidList[i]) == str(pid): print 'pid', pid, 'task', task, 'pidlist', self.pidList[i], 'state list', self.stateList[i], 'task List', self.taskList[i], 'in range',inrange or self.taskList[i]==-1
 
             if str(self.pidList[i]) == str(pid) and (inrange or self.taskList[i]==-1):
-                if str(self.stateList[i]) == 'r' or str(self.stateList[i]) == 'qw' or str(self.stateList[i]) == 't':
-                    return 1  # in the batch
-                else: 
-                    return 2  # error state
-        return 0  # not available
+                return str(self.stateList[i])
+        return ''
+
+    def check_pidstatus(self,arraypid,pidlist,task,debug=False):
+        state = self.get_state(arraypid,pidlist,task,debug)
+        if state is None:
+            return -1
+        if not state:
+            return 0  # not available
+        if state == 'r' or state == 'qw' or state == 't':
+            return 1  # in the batch
+        return 2  # error state
 
 #JSON Format is used to store the submission information
 class HelpJSON:
@@ -108,6 +117,33 @@ class HelpJSON:
                 return mysub
         return None
 
+#name of the OutputTree the InputData write, needed when merging
+def output_tree_name(InputData):
+    OutputTreeName = ""
+    for inputObj in InputData:
+        for mylist in inputObj.io_list.other:
+            if "OutputTree" in mylist:
+                OutputTreeName= mylist[2]
+    return OutputTreeName
+
+#Cycle name and output directory of each cycle, enough to look at a workdir without parsing the xml file
+def write_cycleInfo(workdir,cycles,xmlfile):
+    info = []
+    for cycle in cycles:
+        info.append({'Cyclename':cycle.Cyclename,'OutputDirectory':cycle.OutputDirectory,
+                     'XMLFile':os.path.abspath(xmlfile),'OutputTree':output_tree_name(cycle.Cycle_InputData)})
+    try:
+        infoFile = open(workdir+'/CycleInfoSave.p','wb+')
+        json.dump(info, infoFile)
+        infoFile.close()
+    except IOError as e:
+        print "I/O error({0}): {1}".format(e.errno, e.strerror)
+
+def read_cycleInfo(workdir):
+    if not os.path.isfile(workdir+'/CycleInfoSave.p'):
+        return []
+    return json.load(open(workdir+'/CycleInfoSave.p','r'))
+
 class JobManager(object):
     def __init__(self,options,header,workdir):
         self.header = header #how do I split stuff, sframe_batch header in xml file
@@ -121,12 +157,23 @@ class JobManager(object):
         self.stayAlive = 0 # loop counter to see if program is running 
         self.numOfResubmit =0
         self.watch = None
+        self.watchTime = 0
+        self.watchMaxAge = 4 # seconds a qstat snapshot is used for, one snapshot per check of the status
         self.printString = []
         self.keepGoing = options.keepGoing
         self.exitOnQuestion = options.exitOnQuestion
         self.outputstream = self.workdir+'/Stream_'
-    #read xml file and do the magic 
-    def process_jobs(self,InputData,Job):
+        self.submitter = None # set by the monitor loop, qsub is then called in a separate thread
+        self.fileWorker = None # set by the monitor loop, output files are then copied and opened in a separate thread
+        self.logIndex = None # failure messages in the logs of the jobs, read when a job has to be resubmitted
+        self.logsScanned = False
+        self.resultEntries = set() # processes listed with their files in Result.xml
+        self.combining = set() # (process name, task) of split tasks whose parts are being added
+        self.jobStatus = statusWatcher(workdir) if header.Heartbeat else None # records written by the jobs themselves
+        self.accountTries = {} # (process name, task) -> [qacct calls, time of the last one] for jobs without usage
+    #read xml file and do the magic, plans can be shared between workdirs so that the splitting is done only once.
+    #prepared is called with the SubInfo of each process as soon as its xml files and script are written
+    def process_jobs(self,InputData,Job,plans=None,prepared=None):
         jsonhelper = HelpJSON(self.workdir+'/SubmissinInfoSave.p')
         number_of_processes = len(InputData)
         gc.disable()
@@ -139,36 +186,112 @@ class JobManager(object):
                 if found:
                     self.subInfo.append(found)
             if not found:
-                self.subInfo.append(SubInfo(InputData[process].Version,write_all_xml(self.workdir+'/'+InputData[process].Version,processName,self.header,Job,self.workdir),InputData[process].Type))
+                if plans is not None and InputData[process].Version in plans:
+                    plan = plans[InputData[process].Version]
+                else:
+                    plan = plan_jobs(processName,self.header,Job)
+                    if plans is not None: plans[InputData[process].Version] = plan
+                self.subInfo.append(SubInfo(InputData[process].Version,write_plan(self.workdir+'/'+InputData[process].Version,plan,self.header,Job,self.workdir),InputData[process].Type))
             if self.subInfo[-1].numberOfFiles == 0:
                 print 'Removing',self.subInfo[-1].name
                 self.subInfo.pop()
             else:
                 self.totalFiles += self.subInfo[-1].numberOfFiles
                 self.subInfo[-1].reset_resubmit(self.header.AutoResubmit) #Reset the retries every time you start
-                write_script(processName[0],self.workdir,self.header) #Write the scripts you need to start the submission
+                write_script(processName[0],self.workdir,self.header,self.resources(self.subInfo[-1])) #Write the scripts you need to start the submission
+                if prepared: prepared(self.subInfo[-1])
         gc.enable()
+    #load the submission information of an existing workdir, no xml files are touched
+    def load_jobs(self):
+        jsonhelper = HelpJSON(self.workdir+'/SubmissinInfoSave.p')
+        if not jsonhelper.data:
+            return
+        #check_jobstatus stores the processes in reversed order
+        for element in reversed(jsonhelper.data):
+            mysub = SubInfo()
+            mysub.load_Dict(json.loads(element))
+            self.subInfo.append(mysub)
+            self.totalFiles += mysub.numberOfFiles
     #submit the jobs to the batch as array job
     #the used function should soon return the pid of the job for killing and knowing if something failed
     def submit_jobs(self,OutputDirectory,nameOfCycle):
         for process in self.subInfo:
-            process.startingTime = time.time()
-            process.arrayPid = submit_qsub(process.numberOfFiles,self.outputstream+str(process.name),str(process.name),self.workdir)
-            print 'Submitted jobs',process.name, 'pid', process.arrayPid
-            process.reachedBatch = [False]*process.numberOfFiles
-            if process.status != 0:
-                process.status = 0
-            if any(process.pids): 
-                process.pids = ['']*process.numberOfFiles
+            self.submit_process(process)
+    #array job of one process, used directly when the submission is pipelined with the preparation
+    def submit_process(self,process):
+        first = last = None
+        process.reachedBatch = [False]*process.numberOfFiles
+        if self.header.MemoStore:
+            missing = self.memoize(process)
+            if not missing:
+                print 'All jobs of',process.name,'taken from the memo store'
+                return
+            first, last = missing[0], missing[-1]
+        process.startingTime = time.time()
+        process.arrayPid = submit_qsub(last or process.numberOfFiles,self.outputstream+str(process.name),str(process.name),self.workdir,first or 1)
+        print 'Submitted jobs',process.name, 'pid', process.arrayPid
+        if process.status != 0:
+            process.status = 0
+        if any(process.pids): 
+            process.pids = ['']*process.numberOfFiles
+    #Tasks whose output is in the memo store are not run, their output is copied into the workdir.
+    #Returns the tasks that still have to run.
+    def memoize(self,process):
+        if not os.path.exists(self.workdir+'/'+MEMO_DIR):
+            os.makedirs(self.workdir+'/'+MEMO_DIR)
+        missing = []
+        for it in range(process.numberOfFiles):
+            if process.jobsDone[it]:
+                continue
+            marker = self.workdir+'/'+MEMO_DIR+'/'+process.name+'_'+str(it+1)
+            text = job_text(self.workdir,process.name,str(it+1))
+            process.memo[it] = (job_key(text) if text else None) or ''
+            if process.memo[it] and fetch_output(self.header.MemoStore,process.memo[it],output_file(text)):
+                open(marker,'w').close()
+                process.jobsDone[it] = True
+                process.reachedBatch[it] = True # never goes to the batch, it must not count as lost
+                continue
+            if os.path.exists(marker): os.remove(marker)
+            missing.append(it+1)
+        if len(missing) < process.numberOfFiles:
+            print process.numberOfFiles-len(missing),'jobs of',process.name,'taken from the memo store'
+        return missing
+    #qstat is only needed for jobs without a record of their own, e.g. jobs that did not start yet, and to
+    #confirm that a job whose heartbeat stopped is really gone
+    def needs_qstat(self):
+        if not self.jobStatus:
+            return True
+        for process in self.subInfo:
+            for it in range(process.numberOfFiles):
+                if process.jobsDone[it]:
+                    continue
+                if process.parts[it] or process.speculation[it] in ('running','killing'):
+                    return True
+                jobid = process.job_id(it)
+                status = self.jobStatus.check_status(jobid)
+                if status is None or (status == 0 and not self.jobStatus.exited(jobid)):
+                    return True
+        return False
+    #qstat snapshot, a new one is only taken if the last one is older than watchMaxAge and it is needed
+    def get_watch(self):
+        if self.watch and not self.needs_qstat():
+            return self.watch
+        if not self.watch or time.time() - self.watchTime > (self.watchMaxAge if self.watch.parserWorked else max(self.watchMaxAge,QSTAT_RETRY)):
+            self.watch = pidWatcher()
+            self.watchTime = time.time()
+        return self.watch
     #resubmit the jobs see above      
     def resubmit_jobs(self):
-        qstat_out = self.watch.parserWorked
+        qstat_out = self.get_watch().parserWorked
         ask = True
         for process in self.subInfo:
 	    for it in process.missingFiles:
-                batchstatus = self.watch.check_pidstatus(process.pids[it-1],process.arrayPid,it)
-                if qstat_out and batchstatus==-1 and ask:
-                    print '\n' + qstat_out
+                if process.parts[it-1]:
+                    batchstatus = self.parts_batchStatus(process,it-1,[])
+                else:
+                    batchstatus = self.watch.check_pidstatus(process.arrayPid,process.pids[it-1],it)
+                if qstat_out and batchstatus==1 and ask:
+                    print 'Job',process.name,it,'is still on the batch'
                     if self.exitOnQuestion:
                         exit(-1)
                     elif not self.keepGoing:
@@ -177,39 +300,70 @@ class JobManager(object):
                             exit(-1)
                     ask = False
                 if batchstatus != 1:
-                    process.pids[it-1] = resubmit(self.outputstream+process.name,process.name+'_'+str(it),self.workdir,self.header)
-                    #print 'Resubmitted job',process.name,it, 'pid', process.pids[it-1]
-                    self.printString.append('Resubmitted job '+process.name+' '+str(it)+' pid '+str(process.pids[it-1]))
                     if process.status != 0: process.status =0
                     process.reachedBatch[it-1] = False
+                    self.resubmit_task(process,it-1,'Resubmitted')
                     
     #see how many jobs finished, were copied to workdir 
     def check_jobstatus(self, OutputDirectory, nameOfCycle,remove = False, autoresubmit = True):
         missing = open(self.workdir+'/missing_files.txt','w+')
-        waitingFlag_autoresub = False
         missingRootFiles = 0 
-        ListOfDict =[]
-        self.watch = pidWatcher()
+        killList = []
+        accountList = []
+        self.logsScanned = False
+        if self.jobStatus: self.jobStatus.update()
+        self.get_watch()
         ask = True
         for i in xrange(len(self.subInfo)-1, -1, -1):
             process = self.subInfo[i]
-            ListOfDict.append(process.to_JSON())
             rootFiles =0
             self.subInfo[i].missingFiles = []
             for it in range(process.numberOfFiles):
                 if process.jobsDone[it]: 
                     rootFiles+=1
+                    if self.wants_usage(process,it): accountList.append((process,it,process.job_id(it)))
                     continue
-                #have a look at the pids with qstat
-                batchstatus = self.watch.check_pidstatus(process.pids[it],process.arrayPid,it+1)
-                #kill batchjobs with error otherwise update batchinfo
-                batchstatus = process.process_batchStatus(batchstatus,it)
+                #have a look at the pids with qstat, the records of jobs writing heartbeats are used before it
+                heartbeat = None
+                if process.parts[it]:
+                    batchstatus = self.parts_batchStatus(process,it,killList)
+                else:
+                    batchstatus = self.watch.check_pidstatus(process.arrayPid,process.pids[it],it+1)
+                    if self.jobStatus:
+                        heartbeat = self.jobStatus.check_status(process.job_id(it))
+                        #a job with a stale heartbeat is only dead once qstat does not show it anymore
+                        if heartbeat == 0 and not self.jobStatus.exited(process.job_id(it)) and (batchstatus == 1 or not self.watch.parserWorked):
+                            heartbeat = None
+                        if heartbeat is not None and batchstatus != 2: batchstatus = heartbeat
+                #kill batchjobs with error otherwise update batchinfo, nothing is known if qstat failed
+                failed = False
+                if self.watch.parserWorked or heartbeat is not None:
+                    jobid = process.job_id(it)
+                    if batchstatus == 2 and jobid in self.watch.killed:
+                        batchstatus = -2
+                    else:
+                        batchstatus = process.process_batchStatus(batchstatus,it)
+                        if batchstatus == -2: killList.append((process,it,jobid))
+                    if heartbeat == 0:
+                        process.reachedBatch[it] = True
+                        failed = self.jobStatus.failed(jobid) # no need to wait for NotFoundTimeout
+                    if batchstatus == 1 and not process.runningSince[it] and not process.parts[it] and (heartbeat == 1 or self.watch.get_state(process.arrayPid,process.pids[it],it+1) == 'r'):
+                        process.runningSince[it] = time.time()
                 #check if files have arrived 
                 filename = OutputDirectory+'/'+self.workdir+'/'+nameOfCycle+'.'+process.data_type+'.'+process.name+'_'+str(it)+'.root'
+                if process.parts[it]:
+                    self.check_parts(process,it,filename,batchstatus)
+                elif self.header.Speculate > 0 and self.watch.parserWorked:
+                    self.check_speculation(process,it,filename,killList)
                 #if process.jobsRunning[it]:
                 #print filename, os.path.exists(filename), process.jobsRunning[it], process.jobsDone[it], process.arrayPid, process.pids[it]
-                if os.path.exists(filename) and process.startingTime < os.path.getctime(filename) and not process.jobsRunning[it]:
+                if os.path.exists(filename) and process.startingTime < os.path.getctime(filename) and not process.jobsRunning[it] and process.speculation[it] != 'killing':
+                    if process.runningSince[it]: process.runTime[it] = time.time() - process.runningSince[it]
                     process.jobsDone[it] = True
+                    if self.header.MemoStore and process.memo[it] and not process.parts[it]:
+                        self.file_task(add_output,(self.header.MemoStore,process.memo[it],filename))
+                    if self.wants_usage(process,it):
+                        accountList.append((process,it,process.job_id(it)))
                 if not process.jobsDone[it]:
                     missing.write(self.workdir+'/'+nameOfCycle+'.'+process.data_type+'.'+process.name+'_'+str(it)+'.root  sframe_main '+process.name+'_'+str(it+1)+'.xml\n')
                     self.subInfo[i].missingFiles.append(it+1)
@@ -219,13 +373,14 @@ class JobManager(object):
                 #auto resubmit if job dies, take care that there was some job before and warn the user if more then 10% of jobs die 
                 #print process.name,'batch status',batchstatus, 'process.reachedBatch',process.reachedBatch, 'process status',process.status,'resubmit counter',process.resubmit[it], 'resubmit active',autoresubmit
                 if (
-                    process.notFoundCounter[it] > 5 and
+                    (process.notFoundTime(it) > self.header.NotFoundTimeout or failed) and
                     not process.jobsRunning[it] and
                     not process.jobsDone[it] and 
                     process.reachedBatch[it] and
                     (process.resubmit[it] ==-1 or process.resubmit[it]>0) and
                     (process.pids[it] or process.arrayPid) and
-                    autoresubmit
+                    autoresubmit and
+                    self.check_failure(process,it)
                 ):
                     if float(self.numOfResubmit)/float(self.totalFiles) >.10 and ask:
                         if self.exitOnQuestion:
@@ -235,21 +390,19 @@ class JobManager(object):
                             if res.lower() != 'y':
                                 exit(-1)
                         ask = False
-                    #print 'resubmitting', process.name+'_'+str(it+1),es not Found',process.notFoundCounter[it], 'pid', process.pids[it], process.arrayPid, 'task',it+1
-                    waitingFlag_autoresub = True
-                    process.pids[it] = resubmit(self.outputstream+process.name,process.name+'_'+str(it+1),self.workdir,self.header)
-                    #print 'AutoResubmitted job',process.name,it, 'pid', process.pids[it]
+                    #print 'resubmitting', process.name+'_'+str(it+1),'not Found since',process.notFoundTime(it), 'pid', process.pids[it], process.arrayPid, 'task',it+1
                     self.printString.append('File Found '+str(os.path.exists(filename)))
                     if os.path.exists(filename): self.printString.append('Timestamp is ok '+str(process.startingTime < os.path.getctime(filename)))
-                    self.printString.append('AutoResubmitted job '+process.name+' '+str(it)+' pid '+str(process.pids[it]))
-                    #time.sleep(5)
                     process.reachedBatch[it] = False
+                    process.notFoundSince[it] = 0
+                    if process.status == 4: process.status = 0
                     if process.resubmit[it] > 0 : 
                         process.resubmit[it] -= 1
                         self.numOfResubmit +=1
+                    self.resubmit_task(process,it)
             # final status updates
             if (
-                any( i > 6 for i in process.notFoundCounter) and
+                any(process.notFoundTime(it) > self.header.NotFoundTimeout for it in range(process.numberOfFiles)) and
                 not any(process.jobsRunning) and
                 not all(process.jobsDone) and
                 all(process.reachedBatch) # basically set to error when nothing is running anymore & everything was on the batch
@@ -257,8 +410,8 @@ class JobManager(object):
                 process.status = 4
             ###Debugging is ongoing
             """
-            if any( i > 6 for i in process.notFoundCounter):
-                print 'Process', process.name,'not found i-times',i
+            if any(process.notFoundTime(it) > self.header.NotFoundTimeout for it in range(process.numberOfFiles)):
+                print 'Process', process.name,'not found for some time'
                 print 'Jobs Running? ', any(process.jobsRunning)
                 print 'Jobs Done?', all(process.jobsDone)
                 print 'Jobs reached Batch?', all(process.reachedBatch)
@@ -266,6 +419,10 @@ class JobManager(object):
             if all(process.jobsDone) and not process.status == 2:
                 process.status = 1
             process.rootFileCounter=rootFiles
+        if killList:
+            self.kill_jobs(killList)
+        if accountList:
+            self.harvest_usage(accountList)
         try:
             missing.close()
         except IOError as e:
@@ -273,15 +430,236 @@ class JobManager(object):
             
         self.missingFiles = missingRootFiles
         #Save/update pids and other information to json file, such that it can be loaded and used later
+        ListOfDict = [process.to_JSON() for process in reversed(self.subInfo)]
         try:
             jsonFile = open(self.workdir+'/SubmissinInfoSave.p','wb+')
             json.dump(ListOfDict, jsonFile)
             jsonFile.close()
         except IOError as e:
             print "I/O error({0}): {1}".format(e.errno, e.strerror)
-        if(waitingFlag_autoresub): time.sleep(5)
+
+    #Looks for the reason of the failure of a job in its logs, False if it would fail again when resubmitted.
+    #The logs are scanned at most once per check of the status.
+    def check_failure(self,process,it):
+        if not self.logsScanned:
+            if not self.logIndex:
+                self.logIndex = LogIndex(self.workdir)
+            self.logIndex.scan()
+            self.logsScanned = True
+        failure = self.logIndex.classify(process.job_id(it)) or 'transient'
+        if failure != process.failure[it]:
+            process.failure[it] = failure
+            if failure == 'fatal':
+                self.printString.append('Job '+process.name+' '+str(it)+' pid '+process.job_id(it)+' failed with a fatal error, see its log. Not resubmitted')
+        return failure != 'fatal'
+
+    #resubmit a single task, with a submitter the qsub call is done in its thread and the pid set afterwards.
+    #A task that failed too often is split into parts, of a split task only the missing parts are resubmitted.
+    def resubmit_task(self,process,it,label='AutoResubmitted'):
+        process.failures[it] += 1
+        process.runningSince[it] = 0
+        if not process.parts[it] and self.header.Resplit > 1 and process.failures[it] >= self.header.ResplitAfter:
+            partNames = resplit_job(self.workdir,process.name,str(it+1),self.header.Resplit)
+            if partNames:
+                self.printString.append('Split job '+process.name+' '+str(it)+' into '+str(len(partNames))+' parts')
+                process.parts[it] = ['']*len(partNames)
+                process.partsDone[it] = [False]*len(partNames)
+                process.pids[it] = ''
+        if process.parts[it]:
+            for part in xrange(len(process.parts[it])):
+                if process.partsDone[it][part]: continue
+                partName = process.name+'_'+str(it+1)+'_part'+str(part+1)
+                args = (self.outputstream+process.name,partName,self.workdir,self.header,partName+'.xml',self.resources(process))
+                self.submit_task(args,lambda pid, part=part: self.set_resubmitted(process,it,pid,label,part))
+            return
+        args = (self.outputstream+process.name,process.name+'_'+str(it+1),self.workdir,self.header,None,self.resources(process))
+        if self.submitter: process.pids[it] = ''
+        self.submit_task(args,lambda pid: self.set_resubmitted(process,it,pid,label))
+
+    #func(*args) for output files, in the file worker of the monitor loop if there is one, callback gets the result
+    def file_task(self,func,args,callback=lambda result: None):
+        if self.fileWorker:
+            self.fileWorker(func,args,callback)
+        else:
+            callback(func(*args))
+
+    def submit_task(self,args,callback):
+        if self.submitter:
+            self.submitter(resubmit,args,callback)
+            return
+        try:
+            pid = resubmit(*args)
+        except Exception as e:
+            print 'Resubmission of',args[1],'failed:',e
+            pid = None
+        callback(pid)
+
+    #pid is None if qsub failed, the task is then set back such that the next check resubmits it again
+    def set_resubmitted(self,process,it,pid,label='AutoResubmitted',part=None):
+        if not pid:
+            self.printString.append(label+' job '+process.name+' '+str(it)+' could not be submitted, trying again')
+            process.failures[it] -= 1
+            if label == 'AutoResubmitted' and process.resubmit[it] != -1: process.resubmit[it] += 1 # the try check_jobstatus took
+            process.reachedBatch[it] = True
+            process.notFoundSince[it] = 1 # long ago, no need to wait for NotFoundTimeout
+            return
+        if part is None:
+            process.pids[it] = pid
+            self.printString.append(label+' job '+process.name+' '+str(it)+' pid '+str(pid))
+        else:
+            process.parts[it][part] = pid
+            self.printString.append(label+' job '+process.name+' '+str(it)+' part '+str(part+1)+' pid '+str(pid))
+
+    #A copy of a job running much longer than the finished jobs of the process is started, it writes into
+    #the speculative directory. Whichever is done first is used, the other job is killed. If the copy finished
+    #first, the original job is killed and its output is only replaced once it is off the batch.
+    def check_speculation(self,process,it,filename,killList):
+        specFile = os.path.dirname(filename)+'/speculative/'+os.path.basename(filename)
+        before = process.speculation[it]
+        if process.speculation[it] == 'running':
+            specPid = process.speculativePid[it]
+            specStatus = self.watch.check_pidstatus(0,specPid,-1) if specPid else 1
+            if os.path.exists(filename) and process.startingTime < os.path.getctime(filename) and not process.jobsRunning[it]:
+                if specStatus > 0: killList.append((process,it,specPid))
+                process.speculation[it] = 'lost'
+            elif specStatus != 1 and os.path.exists(specFile) and process.speculativeSince[it] < os.path.getctime(specFile):
+                process.speculation[it] = 'killing'
+                if process.jobsRunning[it]: killList.append((process,it,process.job_id(it)))
+            elif specStatus == 2 or (specStatus == 0 and time.time() - process.speculativeSince[it] > self.header.NotFoundTimeout):
+                if specStatus == 2: killList.append((process,it,specPid))
+                process.speculation[it] = 'failed'
+        if process.speculation[it] == 'killing':
+            if process.jobsRunning[it]:
+                return # the original job could still write its output
+            process.speculation[it] = self.install_speculative(process,filename,specFile)
+        if process.speculation[it] != before and process.speculation[it] != 'killing':
+            self.printString.append('Speculative copy of job '+process.name+' '+str(it)+' '+process.speculation[it])
+        if process.speculation[it]:
+            return
+        if not process.runningSince[it] or process.jobsDone[it]:
+            return
+        runTimes = sorted(runTime for runTime in process.runTime if runTime > 0)
+        if len(runTimes) < SPECULATE_MIN_DONE:
+            return
+        median = runTimes[len(runTimes)/2]
+        if time.time() - process.runningSince[it] < self.header.Speculate*median:
+            return
+        specName = speculative_job(self.workdir,process.name,str(it+1))
+        if not specName:
+            return
+        process.speculation[it] = 'running'
+        process.speculativeSince[it] = time.time()
+        args = (self.outputstream+process.name,specName,self.workdir,self.header,specName+'.xml',self.resources(process))
+        self.submit_task(args,lambda pid: self.set_speculative(process,it,pid))
+
+    #Output of a finished copy put in place of the output of the original job, which is off the batch.
+    #If the original wrote a complete file before it was killed, that one is kept. The file name is claimed
+    #with a hard link, which fails if something else created it meanwhile.
+    def install_speculative(self,process,filename,specFile):
+        if os.path.exists(filename) and process.startingTime < os.path.getctime(filename) and check_FileReadable(filename):
+            os.remove(specFile)
+            return 'lost'
+        try:
+            os.link(specFile,filename)
+            os.remove(specFile)
+            return 'won'
+        except OSError:
+            pass # there is an incomplete or old file, nobody writes it anymore
+        if os.path.exists(filename) and process.startingTime < os.path.getctime(filename) and check_FileReadable(filename):
+            os.remove(specFile)
+            return 'lost'
+        os.rename(specFile,filename)
+        return 'won'
+
+    def set_speculative(self,process,it,pid):
+        if not pid:
+            process.speculation[it] = 'failed'
+            self.printString.append('Speculative copy of job '+process.name+' '+str(it)+' could not be submitted')
+            return
+        process.speculativePid[it] = pid
+        self.printString.append('Started speculative copy of job '+process.name+' '+str(it)+' pid '+str(pid))
+
+    #a split task is on the batch as long as one of its parts is, parts in error state are killed
+    def parts_batchStatus(self,process,it,killList):
+        running = False
+        for pid in process.parts[it]:
+            if not pid: continue
+            batchstatus = self.watch.check_pidstatus(0,pid,-1)
+            if batchstatus == 2 and pid not in self.watch.killed:
+                killList.append((process,it,pid))
+            running = running or batchstatus == 1
+        return 1 if running else 0
+
+    #when all parts of a split task are there they are added to the output file of the task
+    def check_parts(self,process,it,filename,batchstatus):
+        partFiles = [filename[:-len('.root')]+'_part'+str(part+1)+'.root' for part in xrange(len(process.parts[it]))]
+        process.partsDone[it] = [os.path.exists(partFile) and process.startingTime < os.path.getctime(partFile) for partFile in partFiles]
+        if batchstatus == 1 or not all(process.partsDone[it]) or (process.name,it) in self.combining:
+            return
+        if os.path.exists(filename) and process.startingTime < os.path.getctime(filename):
+            return
+        self.combining.add((process.name,it))
+        self.file_task(combine_parts,(filename,partFiles),lambda ok: self.set_combined(process,it,len(partFiles),ok))
+
+    def set_combined(self,process,it,nParts,ok):
+        self.combining.discard((process.name,it))
+        if ok:
+            self.printString.append('Combined '+str(nParts)+' parts of job '+process.name+' '+str(it))
+        else:
+            self.printString.append('Could not combine the parts of job '+process.name+' '+str(it))
+
+    #kill all jobs found in error state or made obsolete with one qdel, with a submitter it runs in its thread
+    def kill_jobs(self,killList):
+        jobids = [jobid for process,it,jobid in killList]
+        self.watch.killed.update(jobids)
+        if self.submitter:
+            self.submitter(delete_jobs,(jobids,),lambda results: self.set_killed(killList,results))
+        else:
+            self.set_killed(killList,delete_jobs(jobids))
+
+    def set_killed(self,killList,results):
+        results = results or {}
+        for process,it,jobid in killList:
+            killed, message = results.get(jobid,(False,'no answer from qdel'))
+            process.set_killStatus(it,killed,message)
+            if killed:
+                self.printString.append('Killed job '+process.name+' '+str(it)+' pid '+jobid)
+            else:
+                self.printString.append('Could not kill job '+process.name+' '+str(it)+' pid '+jobid+': '+message)
         
                 
+    #h_vmem and h_rt for the jobs of a process from the usage of its finished jobs, None to use the defaults
+    def resources(self,process):
+        return resource_request(process.usage,self.header.AutoResources)
+
+    #True if the usage of the finished task should be asked from qacct now, the accounting of SGE lags behind
+    #the end of a job, so a job without a record is asked again every ACCOUNT_RETRY seconds
+    def wants_usage(self,process,it):
+        if not self.header.AutoResources or process.usage[it] is not None or process.parts[it] or process.speculation[it] == 'won':
+            return False
+        tries = self.accountTries.get((process.name,it),[0,0])
+        return time.time() - tries[1] > ACCOUNT_RETRY
+
+    #memory and time used by jobs that finished, with a submitter qacct runs in its thread
+    def harvest_usage(self,accountList):
+        for process,it,jobid in accountList:
+            tries = self.accountTries.setdefault((process.name,it),[0,0])
+            tries[0] += 1
+            tries[1] = time.time()
+        pids = set(jobid.split('.')[0] for process,it,jobid in accountList)
+        if self.submitter:
+            self.submitter(job_accounting,(pids,),lambda usage: self.set_usage(accountList,usage))
+        else:
+            self.set_usage(accountList,job_accounting(pids))
+
+    def set_usage(self,accountList,usage):
+        usage = usage or {}
+        for process,it,jobid in accountList:
+            if jobid in usage:
+                process.usage[it] = usage[jobid]
+            elif self.accountTries[(process.name,it)][0] >= ACCOUNT_TRIES:
+                process.usage[it] = [] # no record, not asked again
+
     #print status of jobs 
     def print_status(self):
         if not self.move_cursor_up_cmd:
@@ -296,29 +674,71 @@ class JobManager(object):
             print item
         self.printString = []
 
+        for line in self.status_lines():
+            print line
+        print '='*80
+
+    #table with the status of each sample, also used by the monitor for several workdirs
+    def status_lines(self):
         stayAliveArray = ['|','/','-','\\']
         if self.stayAlive < 3:
            self.stayAlive +=1  
         else:
             self.stayAlive = 0
 
-        print '%30s: %6s %6s %.6s'% ('Sample Name','Ready','#Files','[%]')
-        readyFiles =0
-
+        lines = ['%30s: %6s %6s %.6s'% ('Sample Name','Ready','#Files','[%]')]
+        status_message = ['\033[94m Working \033[0m','\033[92m Transferred \033[0m','Merging','Already Merged','\033[91m Failed \033[0m']
         for process in self.subInfo:
-            status_message = ['\033[94m Working \033[0m','\033[92m Transferred \033[0m','Merging','Already Merged','\033[91m Failed \033[0m']
             #print process.status
-            print '%30s: %6i %6i %.3i'% (process.name, process.rootFileCounter,process.numberOfFiles, 100*float(process.rootFileCounter)/float(process.numberOfFiles)), status_message[process.status]
-            readyFiles += process.rootFileCounter
-        print 'Number of files: ',readyFiles,'/',self.totalFiles,'(%.3i)' % (100*(1-float(readyFiles)/float(self.totalFiles))),stayAliveArray[self.stayAlive],stayAliveArray[self.stayAlive]
-        print '='*80
+            lines.append('%30s: %6i %6i %.3i '% (process.name, process.rootFileCounter,process.numberOfFiles, 100*float(process.rootFileCounter)/float(process.numberOfFiles)) + status_message[process.status])
+        lines.append('Number of files:  %i / %i (%.3i) %s %s' % (self.get_readyFiles(),self.totalFiles,100*(1-float(self.get_readyFiles())/float(self.totalFiles)),stayAliveArray[self.stayAlive],stayAliveArray[self.stayAlive]))
+        failures = sum([[failure for failure, done in zip(process.failure,process.jobsDone) if failure and not done] for process in self.subInfo],[])
+        if failures:
+            lines[-1] += ' Failed: %i transient %i resource %i fatal' % tuple(failures.count(name) for name in ('transient','resource','fatal'))
+        return lines
+
+    def get_readyFiles(self):
+        return sum(process.rootFileCounter for process in self.subInfo)
     
     #take care of merging
-    def merge_files(self,OutputDirectory,nameOfCycle,InputData):
-        self.merge.merge(OutputDirectory,nameOfCycle,self.subInfo,self.workdir,InputData,self.outputstream)
+    def merge_files(self,OutputDirectory,nameOfCycle,OutputTreeName):
+        if OutputTreeName: self.count_entries(OutputDirectory,nameOfCycle,OutputTreeName)
+        self.merge.merge(OutputDirectory,nameOfCycle,self.subInfo,self.workdir,OutputTreeName,self.outputstream)
+    #Counts the entries of the output files of complete processes and lists the files with their entries in
+    #Result.xml, so that the next stage does not need to open them again. With -l the files are opened in the
+    #file worker of the monitor loop.
+    def count_entries(self,OutputDirectory,nameOfCycle,OutputTreeName):
+        for process in self.subInfo:
+            if not all(process.jobsDone) or process.name in self.resultEntries:
+                continue
+            files = [OutputDirectory+'/'+self.workdir+'/'+nameOfCycle+'.'+process.data_type+'.'+process.name+'_'+str(it)+'.root' for it in range(process.numberOfFiles)]
+            self.resultEntries.add(process.name)
+            if process.entries and -1 not in process.entries:
+                self.set_entries(process,files,process.entries)
+            else:
+                self.file_task(count_files,(files,OutputTreeName),lambda entries, process=process, files=files: self.set_entries(process,files,entries))
+
+    def set_entries(self,process,files,entries):
+        if entries is None:
+            self.resultEntries.discard(process.name) # counted again with the next merge
+            return
+        if -1 in entries:
+            if -1 not in process.entries:
+                self.printString.append('Could not read all files of '+process.name+', Result.xml keeps the wildcard for now')
+            process.entries = entries
+            self.resultEntries.discard(process.name) # counted again with the next merge
+            return
+        process.entries = entries
+        write_result_entries(self.workdir,process.name,files,process.entries)
+    #True once the entries of process are in Result.xml
+    def entries_written(self,process):
+        return process.name in self.resultEntries and bool(process.entries) and -1 not in process.entries
     #wait for every process to finish
     def merge_wait(self):
         self.merge.wait_till_finished()
+    #nothing left to wait for
+    def is_finished(self):
+        return self.get_subInfoFinish() or (not self.merge.get_mergerStatus() and self.missingFiles==0)
     #see how many jobs finished (or error)
     def get_subInfoFinish(self):
         for process in self.subInfo:
@@ -341,14 +761,9 @@ class MergeManager(object):
         else:
             return False
 
-    def merge(self,OutputDirectory,nameOfCycle,info,workdir,InputData,outputdir):
+    def merge(self,OutputDirectory,nameOfCycle,info,workdir,OutputTreeName,outputdir):
         if not self.add and not self.force and not self.onlyhist: return  
         #print "Don't worry your are using nice = 10" 
-        OutputTreeName = ""
-        for inputObj in InputData:
-            for mylist in inputObj.io_list.other:
-                if "OutputTree" in mylist:
-                    OutputTreeName= mylist[2]
         for process in info:
             if not process.numberOfFiles == process.rootFileCounter:
                 continue
@@ -360,6 +775,11 @@ class MergeManager(object):
             #elif process.status !=2: 
             #    process.status = 3
 
+    #number of hadd processes still running, finished ones are removed (and do not stay zombies)
+    def poll(self):
+        self.active_process = [proc for proc in self.active_process if proc and proc.poll() is None]
+        return len(self.active_process)
+
     def wait_till_finished(self):
         if not self.wait: return
         for process in self.active_process:
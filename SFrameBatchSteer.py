@@ -16,21 +16,23 @@ if __name__ == "__main__":
     #import the main function
     from sframe_batch import SFrameBatchMain
 
-    #what you want to do, could also be done in parallel but then monitoring gets more difficult
+    #all variations are done by one sframe_batch: the jobs are split only once, the variations are submitted
+    #in parallel and watched together with one qstat
     variations_variables = ['PU_variation']#'SF_muonID','BTag_variation',
     variations = ['up','down']
     xmlfile = "Sel.xml" # EleSel.xml
+    command = ["-slac",xmlfile]
     for var in variations_variables:
         for value in variations:
-            command_string = "-slac "+xmlfile+" -w workdir."+var+"_"+value+" -o ./"+var+"_"+value+" --ReplaceUserItem "+var+","+value
-
-            if debug :print command_string.split(" ")
-            else:
-                #try:
-                SFrameBatchMain(command_string.split(" "))
-                """
-                except:
-                    print "SFrameBatch did crash during running:"
-                    print command_string 
-                    sys.exit(1)
-                """
+            command += ["--Variation",var+","+value]
+
+    if debug :print command
+    else:
+        #try:
+        SFrameBatchMain(command)
+        """
+        except:
+            print "SFrameBatch did crash during running:"
+            print command
+            sys.exit(1)
+        """
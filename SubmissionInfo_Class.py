@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import subprocess
 import json
 import time
 
@@ -14,41 +13,67 @@ class SubInfo(object):
         self.status = 0   # 0: init, 1: data on disk
         self.missingFiles = []
         self.pids = ['']*numberOfFiles
-        self.notFoundCounter = [0]*numberOfFiles
+        self.notFoundSince = [0]*numberOfFiles # time since when a job is not found on the batch, 0 if it was seen
         self.reachedBatch = [False]*numberOfFiles
         self.jobsRunning = [False]*numberOfFiles
         self.jobsDone = [False]*numberOfFiles
         self.arrayPid = -1
         self.resubmit = [resubmit]*numberOfFiles
         self.startingTime = 0
+        self.killStatus = ['']*numberOfFiles # result of the last qdel of a job in error state
+        self.failures = [0]*numberOfFiles # how often a job was resubmitted
+        self.parts = [[] for it in xrange(numberOfFiles)] # pids of the parts of a job that was split again
+        self.partsDone = [[] for it in xrange(numberOfFiles)]
+        self.runningSince = [0]*numberOfFiles # time the job was first seen running
+        self.runTime = [0]*numberOfFiles # seconds from running to done
+        self.speculation = ['']*numberOfFiles # '', running, killing (the original), won, lost or failed for the copy of a slow job
+        self.speculativePid = ['']*numberOfFiles
+        self.speculativeSince = [0]*numberOfFiles
+        self.failure = ['']*numberOfFiles # transient, resource or fatal from the logs of the last failed job
+        self.entries = [] # entries of the output files once all are there, written into Result.xml
+        self.memo = ['']*numberOfFiles # key of the job in the memo store
+        self.usage = [None]*numberOfFiles # [maxvmem bytes, wall clock s, cpu s] of the finished job from qacct, [] if qacct never had it
     def reset_resubmit(self,value):
         self.resubmit =[value]*self.numberOfFiles
     def to_JSON(self):
         #print json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
         return json.dumps(self, default=lambda o: o.__dict__, sort_keys=True, indent=4)
     def load_Dict(self,data):
-        self.__dict__ = data
+        #start from the defaults, such that information saved by older versions can still be used
+        defaults = SubInfo(data['name'],data['numberOfFiles'],data['data_type']).__dict__
+        defaults.update(data)
+        defaults.pop('notFoundCounter',None) # replaced by notFoundSince
+        self.__dict__ = defaults
+    #seconds since the job was last seen on the batch
+    def notFoundTime(self,it):
+        if not self.notFoundSince[it]:
+            return 0
+        return time.time() - self.notFoundSince[it]
     def process_batchStatus(self,batch,it):
         self.jobsRunning[it] = False
-        self.notFoundCounter[it] += 1
+        if not self.notFoundSince[it]:
+            self.notFoundSince[it] = time.time()
         if batch == 1:
-            self.notFoundCounter[it]=0 # Safeguard, no action is taken if a job is not found once.
+            self.notFoundSince[it] = 0 # Safeguard, no action is taken until a job is missing for some time.
             self.reachedBatch[it] = True # Use to understand when a job reached the batch before taking any action
             self.jobsRunning[it] = True
-        #kill jobs with have an error state
+        #jobs with an error state get killed, the JobManager collects them and calls qdel once for all
         if batch == 2:
+            print 'going to kill job', self.job_id(it)
             if self.pids[it]:
-                print 'going to kill job', self.pids[it]
-                time.sleep(5)
-                subprocess.Popen(['qdel',str(self.pids[it])],stdout=subprocess.PIPE)
                 self.pids[it] ='' # just got killed
-                self.reachedBatch[it] = False;
-                return -2
-            else:
-                print 'going to kill job',str(self.arrayPid)+'.'+str(it+1)
-                time.sleep(5)
-                subprocess.Popen(['qdel',str(self.arrayPid)+'.'+str(it+1)],stdout=subprocess.PIPE)
-                self.reachedBatch[it] = False;
-                return -2
+            self.reachedBatch[it] = False;
+            return -2
         return batch
+    #id for qdel, either the resubmitted job or the task of the array job
+    def job_id(self,it):
+        if self.pids[it]:
+            return str(self.pids[it])
+        return str(self.arrayPid)+'.'+str(it+1)
+    #store what qdel said about a job that was killed
+    def set_killStatus(self,it,killed,message):
+        if killed:
+            self.killStatus[it] = 'killed'
+        else:
+            self.killStatus[it] = 'kill failed: '+message
 
@@ -3,13 +3,59 @@
 from subprocess import call
 from subprocess import Popen
 from subprocess import PIPE
+from subprocess import STDOUT
 import os
+import re
+import math
 
 from tree_checker import *
+from job_status import STATUS_DIR
+from memo_store import MEMO_DIR
 #from fhadd import fhadd
 
+SGE_UNITS = {'K':2**10,'M':2**20,'G':2**30,'T':2**40}
+MIN_VMEM = 2**29 # smallest h_vmem requested from the accounting, 512M
+MIN_RUNTIME = 900 # smallest h_rt requested from the accounting in seconds
 
-def write_script(name,workdir,header):
+
+#command that runs task of process name on the node, with staging, heartbeats or a manifest it goes through batch_job.py
+def sframe_command(name,task,header):
+    if not header.Manifest:
+        return xml_command(name+'_'+task+'.xml',header)
+    return batch_job_command(header)+' --manifest '+name+'.manifest --task '+task
+
+#command that runs an existing xml file
+def xml_command(xmlname,header):
+    if not header.Stage and not header.Heartbeat:
+        return 'sframe_main '+xmlname
+    return batch_job_command(header)+' '+xmlname
+
+def batch_job_command(header):
+    command = 'python '+os.path.dirname(os.path.abspath(__file__))+'/batch_job.py'
+    if header.Stage:
+        command += ' --stage --parallel '+str(header.StageParallel)
+    if header.Heartbeat:
+        command += ' --heartbeat '+STATUS_DIR
+    return command
+
+#h_vmem and h_rt for the jobs of a process, taken from what its finished jobs used with a margin.
+#None if nothing is known yet or AutoResources is not used
+def resource_request(usage,margin):
+    usage = [u for u in usage if u]
+    if not margin or not usage:
+        return None
+    vmem = max(max(u[0] for u in usage)*margin,MIN_VMEM)
+    runtime = int(math.ceil(max(max(u[1] for u in usage)*margin,MIN_RUNTIME)))
+    return str(int(math.ceil(vmem/2**20)))+'M', '%02i:%02i:%02i' % (runtime/3600,runtime%3600/60,runtime%60)
+
+#tasks taken from the memo store are marked in the workdir and not run
+def memo_check(name,header):
+    if not header.MemoStore:
+        return ''
+    return '[ -e '+MEMO_DIR+'/'+name+'_${SGE_TASK_ID} ] && exit 0\n'
+
+def write_script(name,workdir,header,resources=None):
+    h_vmem, h_rt = resources or (header.RAM+'G','03:00:00')
     myfile = open(workdir+'/split_script_'+name+'.sh','w')
     
     myfile.write(
@@ -28,19 +74,24 @@ def write_script(name,workdir,header):
 ##running in local mode with 8-12 cpu slots
 ##$ -pe local 8-12
 ## running time, normaly 3h should be enough
-#$ -l h_rt=03:00:00
+#$ -l h_rt="""+h_rt+"""
 ##CPU memory
-#$ -l h_vmem="""+header.RAM+"""G
+#$ -l h_vmem="""+h_vmem+"""
 ##DISK memory
 #$ -l h_fsize="""+header.DISK+"""G   
 cd """+workdir+"""
-sframe_main """+name+"""_${SGE_TASK_ID}.xml
+"""+memo_check(name,header)+sframe_command(name,'${SGE_TASK_ID}',header)+"""
 """)
     
     myfile.close()
 
 
-def resub_script(name,workdir,header):
+def resub_script(name,workdir,header,xmlname=None,resources=None):
+    h_vmem, h_rt = resources or ('8G','03:00:00')
+    if xmlname:
+        command = xml_command(xmlname,header)
+    else:
+        command = sframe_command(name.rsplit('_',1)[0],name.rsplit('_',1)[1],header)
     myfile = open(workdir+'/split_script_'+name+'.sh','w')
     
     myfile.write(
@@ -59,19 +110,19 @@ def resub_script(name,workdir,header):
 ##running in local mode with 8-12 cpu slots
 ##$ -pe local 8-12
 ## running time, normaly 3h should be enough
-#$ -l h_rt=03:00:00
+#$ -l h_rt="""+h_rt+"""
 ##CPU memory
 ##$ -l h_vmem="""+header.RAM+"""G
-#$ -l h_vmem=8G
+#$ -l h_vmem="""+h_vmem+"""
 ##DISK memory
 #$ -l h_fsize="""+header.DISK+"""G   
 cd """+workdir+"""
-sframe_main """+name+""".xml
+"""+command+"""
 
 """)    
     myfile.close()
 
-def submit_qsub(NFiles,Stream,name,workdir):
+def submit_qsub(NFiles,Stream,name,workdir,first=1):
     #print '-t 1-'+str(int(NFiles))
     #call(['ls','-l'], shell=True)
 
@@ -80,13 +131,13 @@ def submit_qsub(NFiles,Stream,name,workdir):
         print Stream+' has been created'
  
     #call(['qsub'+' -t 1-'+str(NFiles)+' -o '+Stream+'/'+' -e '+Stream+'/'+' '+workdir+'/split_script_'+name+'.sh'], shell=True)
-    proc_qstat = Popen(['qsub'+' -t 1-'+str(NFiles)+' -o '+Stream+'/'+' -e '+Stream+'/'+' '+workdir+'/split_script_'+name+'.sh'],shell=True,stdout=PIPE)
+    proc_qstat = Popen(['qsub'+' -t '+str(first)+'-'+str(NFiles)+' -o '+Stream+'/'+' -e '+Stream+'/'+' '+workdir+'/split_script_'+name+'.sh'],shell=True,stdout=PIPE)
     return (proc_qstat.communicate()[0].split()[2]).split('.')[0]
 
 
-def resubmit(Stream,name,workdir,header):
+def resubmit(Stream,name,workdir,header,xmlname=None,resources=None):
     #print Stream ,name
-    resub_script(name,workdir,header)	
+    resub_script(name,workdir,header,xmlname,resources)	
     if not os.path.exists(Stream):
         os.makedirs(Stream)
         print Stream+' has been created'
@@ -94,6 +145,86 @@ def resubmit(Stream,name,workdir,header):
     proc_qstat = Popen(['qsub'+' -o '+Stream+'/'+' -e '+Stream+'/'+' '+workdir+'/split_script_'+name+'.sh'],shell=True,stdout=PIPE)
     return proc_qstat.communicate()[0].split()[2]
 
+#Deletes many jobs with as few qdel calls as possible, tasks of the same array job are given as ranges.
+#jobids are 'pid' or 'pid.task', returns a dict jobid -> (deleted, message)
+def delete_jobs(jobids,maxArgs=500):
+    args = {} # qdel argument -> job ids it stands for
+    arrayTasks = {}
+    for jobid in set(jobids):
+        if '.' in jobid:
+            pid, task = jobid.split('.')
+            arrayTasks.setdefault(pid,[]).append(int(task))
+        else:
+            args[jobid] = [jobid]
+    for pid, tasks in arrayTasks.iteritems():
+        tasks.sort()
+        first = 0
+        for i in range(len(tasks)):
+            if i+1 == len(tasks) or tasks[i+1] != tasks[i]+1:
+                arg = pid+'.'+str(tasks[first]) if first == i else pid+'.'+str(tasks[first])+'-'+str(tasks[i])
+                args[arg] = [pid+'.'+str(t) for t in tasks[first:i+1]]
+                first = i+1
+
+    results = {}
+    argList = args.keys()
+    for i in range(0,len(argList),maxArgs):
+        chunk = argList[i:i+maxArgs]
+        proc = Popen(['qdel']+chunk,stdout=PIPE,stderr=STDOUT)
+        output = proc.communicate()[0]
+        chunkIds = sum([args[arg] for arg in chunk],[])
+        for jobid in chunkIds:
+            results[jobid] = (proc.returncode == 0,'qdel exit code '+str(proc.returncode))
+        #qdel prints one line per job or task, e.g. 'user has registered the job-array task 123.4 for deletion'
+        #or 'denied: job "123" does not exist'
+        for line in output.splitlines():
+            deleted = 'delet' in line and 'denied' not in line
+            for pid, first, last in re.findall(r'(\d+)(?:\.(\d+)(?:-(\d+))?)?',line):
+                for jobid in chunkIds:
+                    jobpid, dot, task = jobid.partition('.')
+                    if jobpid != pid or (first and not task):
+                        continue
+                    if not first or int(first) <= int(task) <= int(last or first):
+                        results[jobid] = (deleted,line.strip())
+    return results
+
+#qacct values like '1.234G' or '123.000s' as float in bytes or seconds
+def sge_value(value):
+    value = value.strip().rstrip('s')
+    try:
+        if value and value[-1].upper() in SGE_UNITS:
+            return float(value[:-1])*SGE_UNITS[value[-1].upper()]
+        return float(value)
+    except ValueError:
+        return 0
+
+#Memory and time used by finished jobs from the accounting of the batch system, one qacct call per pid.
+#Returns a dict jobid -> [maxvmem in bytes, wall clock seconds, cpu seconds], jobids as in delete_jobs
+def job_accounting(pids):
+    usage = {}
+    for pid in set(pids):
+        proc = Popen(['qacct','-j',str(pid)],stdout=PIPE,stderr=PIPE)
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            continue
+        #one record per job or task separated by a line of '=', a task run several times has several records
+        for record in re.split(r'\n=+\n','\n'+output):
+            fields = dict(line.split(None,1) for line in record.splitlines() if len(line.split(None,1)) == 2)
+            if fields.get('jobnumber','').strip() != str(pid):
+                continue
+            task = fields.get('taskid','undefined').strip()
+            jobid = str(pid) if task == 'undefined' else str(pid)+'.'+task
+            usage[jobid] = [sge_value(fields.get(key,'0')) for key in ('maxvmem','ru_wallclock','cpu')]
+    return usage
+
+#adds the outputs of the parts of a split job into its output file, through a temporary name
+def combine_parts(filename,partFiles):
+    tmpfile = filename[:-len('.root')]+'_combining.root'
+    with open(os.devnull,'w') as devnull:
+        if call(['hadd','-f',tmpfile]+partFiles,stdout=devnull,stderr=devnull) != 0:
+            return False
+    os.rename(tmpfile,filename)
+    return True
+
 def add_histos(directory,name,NFiles,workdir,outputTree, onlyhists,outputdir):
     if not os.path.exists(outputdir):
         os.makedirs(outputdir)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Runs sframe_main for one job on the batch node, called by the scripts of write_script and resub_script.
+# With --stage the input files are first copied to the local disk of the node ($TMPDIR) and sframe_main
+# reads the local copies and writes its output there. Only if sframe_main succeeded the output files are
+# copied next to their destination and renamed, so the JobManager never sees half written root files.
+# With --manifest the xml file of the task is first written from the manifest of the process.
+# With --heartbeat the job writes its start, heartbeat and exit records for the JobManager (see job_status.py).
+
+import os
+import re
+import sys
+import shutil
+import tempfile
+import subprocess
+from optparse import OptionParser
+from multiprocessing.pool import ThreadPool
+from xml.sax.saxutils import escape, unescape
+
+IN_FILENAME = re.compile(r'(<In\s[^>]*?FileName=")([^"]*)(")')
+CYCLE_OUTPUTDIR = re.compile(r'(<Cycle\s[^>]*?OutputDirectory=")([^"]*)(")')
+
+#copies a file to the local disk, if that fails it is read from where it is
+def stage_in(args):
+    filename, local = args
+    try:
+        shutil.copyfile(filename,local)
+        return filename, local
+    except (IOError,OSError) as e:
+        print 'Could not stage',filename,e,'reading it directly'
+        return filename, filename
+
+#copy to a temporary name in the destination directory, the rename at the end is atomic
+def stage_out(local,destination):
+    tmpfile = os.path.join(os.path.dirname(destination),'.'+os.path.basename(destination)+'.staging.'+str(os.getpid()))
+    shutil.copyfile(local,tmpfile)
+    os.rename(tmpfile,destination)
+
+#xml file of the job with the inputs and the output directory on the local disk
+def stage_job(xmlfile,stagedir,parallel):
+    text = open(xmlfile).read()
+    inputdir = os.path.join(stagedir,'input')
+    outputdir = os.path.join(stagedir,'output')
+    os.makedirs(inputdir)
+    os.makedirs(outputdir)
+
+    # only files on a mounted file system can be copied, dcap:// or root:// are read as before
+    filenames = []
+    for prefix, filename, suffix in IN_FILENAME.findall(text):
+        filename = unescape(filename)
+        if os.path.isfile(filename) and filename not in filenames:
+            filenames.append(filename)
+    copies = [(filename,os.path.join(inputdir,str(i)+'_'+os.path.basename(filename))) for i, filename in enumerate(filenames)]
+    pool = ThreadPool(max(1,parallel))
+    staged = dict(pool.map(stage_in,copies))
+    pool.close()
+    print 'Staged',len([f for f in staged if staged[f] != f]),'of',len(filenames),'input files to',inputdir
+
+    text = IN_FILENAME.sub(lambda m: m.group(1)+escape(staged.get(unescape(m.group(2)),unescape(m.group(2))))+m.group(3),text)
+    destinations = [unescape(d) for p, d, s in CYCLE_OUTPUTDIR.findall(text)]
+    text = CYCLE_OUTPUTDIR.sub(lambda m: m.group(1)+escape(outputdir)+'/'+m.group(3),text)
+
+    stagedxml = os.path.join(stagedir,os.path.basename(xmlfile))
+    with open(stagedxml,'w') as f:
+        f.write(text)
+    dtd = os.path.join(os.path.dirname(os.path.abspath(xmlfile)),'JobConfig.dtd')
+    if os.path.exists(dtd):
+        shutil.copy(dtd,stagedir)
+    return stagedxml, outputdir, destinations
+
+def run_staged(xmlfile,parallel):
+    stagedir = tempfile.mkdtemp(prefix='sframe_',dir=os.environ.get('TMPDIR','/tmp'))
+    try:
+        stagedxml, outputdir, destinations = stage_job(xmlfile,stagedir,parallel)
+        returncode = subprocess.call(['sframe_main',stagedxml],cwd=stagedir)
+        if returncode != 0:
+            print 'sframe_main failed with',returncode,'no output is copied back'
+            return returncode
+        if len(set(destinations)) != 1:
+            print 'Expected one output directory, found',destinations
+            return 1
+        for name in os.listdir(outputdir):
+            stage_out(os.path.join(outputdir,name),os.path.join(destinations[0],name))
+            print 'Copied',name,'to',destinations[0]
+        return 0
+    finally:
+        shutil.rmtree(stagedir,ignore_errors=True)
+
+#xml file of a task written from the manifest into directory, JobConfig.dtd is needed next to it
+def manifest_job(manifest,task,directory):
+    from io_func import read_manifest_xml
+    name = os.path.basename(manifest)[:-len('.manifest')]
+    xmlfile = os.path.join(directory,name+'_'+task+'.xml')
+    with open(xmlfile,'w') as f:
+        f.write(read_manifest_xml(manifest,task))
+    dtd = os.path.join(os.path.dirname(os.path.abspath(manifest)),'JobConfig.dtd')
+    if os.path.exists(dtd) and not os.path.exists(os.path.join(directory,'JobConfig.dtd')):
+        shutil.copy(dtd,directory)
+    return xmlfile
+
+def run_job(options,xmlfile):
+    if options.heartbeat:
+        from job_status import run_with_heartbeat
+        return run_with_heartbeat(options.heartbeat,lambda: run_sframe(options,xmlfile))
+    return run_sframe(options,xmlfile)
+
+def run_sframe(options,xmlfile):
+    if options.stage:
+        return run_staged(xmlfile,options.parallel)
+    return subprocess.call(['sframe_main',xmlfile])
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="usage: %prog [options] xmlfile")
+    parser.add_option("--stage",
+                      action="store_true",
+                      dest="stage",
+                      default=False,
+                      help="Copy inputs and outputs through the local disk of the node.")
+    parser.add_option("--parallel",
+                      action="store",
+                      type="int",
+                      dest="parallel",
+                      default=4,
+                      help="Number of input files copied at the same time.")
+    parser.add_option("--manifest",
+                      action="store",
+                      dest="manifest",
+                      help="Manifest of the process written by sframe_batch, used instead of the xml file.")
+    parser.add_option("--task",
+                      action="store",
+                      dest="task",
+                      help="Task of the manifest to run, usually $SGE_TASK_ID.")
+    parser.add_option("--heartbeat",
+                      action="store",
+                      dest="heartbeat",
+                      help="Directory the start, heartbeat and exit records of the job are written to.")
+    parser.add_option("--writeXML",
+                      action="store_true",
+                      dest="writeXML",
+                      default=False,
+                      help="Only write the xml file of the task from the manifest into the current directory.")
+    (options, args) = parser.parse_args()
+
+    if not options.manifest:
+        if len(args) != 1:
+            parser.error("wrong number of arguments")
+        sys.exit(run_job(options,args[0]))
+    if not options.task:
+        parser.error("--manifest needs --task")
+    if options.writeXML:
+        print 'Written',manifest_job(options.manifest,options.task,os.curdir)
+        sys.exit(0)
+    xmldir = tempfile.mkdtemp(prefix='sframe_xml_',dir=os.environ.get('TMPDIR','/tmp'))
+    try:
+        returncode = run_job(options,manifest_job(options.manifest,options.task,xmldir))
+    finally:
+        shutil.rmtree(xmldir,ignore_errors=True)
+    sys.exit(returncode)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Stages given with --chain run on the output of the stage before them. As soon as all files of a sample of
+# one stage are there and can be opened, the same sample (same Version) is prepared and submitted in the next
+# stage, so the stages overlap sample by sample. Every stage has its own config xml and workdir, the InputData
+# of the next stage has to read the output of the one before, e.g. taken from its Result.xml.
+
+import os
+import shutil
+
+from monitor import *
+
+class ChainStage(object):
+    def __init__(self,options,xmlfile,scriptpath):
+        self.options = options
+        self.xmlfile = os.path.abspath(xmlfile)
+        self.header = fileheader(xmlfile)
+        self.workdir = self.header.Workdir or 'workdir'
+        self.next = None # stage after this one
+        self.target = None # MonitorTarget once the first sample was submitted
+        self.inflight = set() # samples being prepared and submitted by a worker
+        if not os.path.exists(self.workdir+'/'):
+            os.makedirs(self.workdir+'/')
+            print self.workdir,'has been created'
+            shutil.copy(scriptpath+'JobConfig.dtd',self.workdir)
+            shutil.copy(xmlfile,self.workdir)
+        self.manager = JobManager(options,self.header,self.workdir)
+        #samples chained by an earlier call of sframe_batch are watched again
+        self.manager.load_jobs()
+        self.chained = set(process.name for process in self.manager.subInfo)
+        for cycle in read_cycleInfo(self.workdir):
+            if self.manager.subInfo:
+                self.target = MonitorTarget(self.manager,cycle['OutputDirectory'],cycle['Cyclename'].replace('::','.'),cycle['OutputTree'])
+
+    #True if sample name is chained already or on its way
+    def waiting(self,name):
+        return name in self.chained or name in self.inflight
+
+    #Prepares sample process of target in this stage, called by the file worker: the outputs are opened, the xml is
+    #read and the jobs are planned and written. A JobManager of its own is used, the one watched by the loop is only
+    #changed in add_chained. Returns the cycle and the SubInfo of the sample, None if it can not be chained yet and
+    #(None,[]) if it can not be chained at all.
+    def prepare(self,process,target):
+        for it in range(process.numberOfFiles):
+            filename = target.OutputDirectory+'/'+target.manager.workdir+'/'+target.nameOfCycle+'.'+process.data_type+'.'+process.name+'_'+str(it)+'.root'
+            if not check_FileReadable(filename):
+                print 'Not chaining',process.name,'to',self.workdir,'yet, could not read',filename
+                return None
+        Job = parse_jobconfig(self.xmlfile,[process.name])
+        if not Job.Job_Cylce or not Job.Job_Cylce[0].Cycle_InputData:
+            print 'No InputData',process.name,'in',self.xmlfile
+            return None, []
+        cycle = Job.Job_Cylce[0]
+        if cycle.OutputDirectory.startswith('./'):
+            cycle.OutputDirectory = os.getcwd()+cycle.OutputDirectory[1:]
+        print 'Chaining',process.name,'to',self.workdir
+        manager = JobManager(self.options,self.header,self.workdir)
+        manager.process_jobs(cycle.Cycle_InputData,Job)
+        return cycle, manager.subInfo
+
+    #Submits what prepare returned, called by the qsub worker
+    def submit(self,result):
+        manager = JobManager(self.options,self.header,self.workdir)
+        for process in result[1]:
+            manager.submit_process(process)
+        return result
+
+    #Called by the loop with what prepare returned, the sample counts as chained only if it was submitted.
+    #Returns the target of this stage if it is new.
+    def add_chained(self,process,result):
+        self.inflight.discard(process.name)
+        if not result:
+            return None # tried again by the next advance of the chain
+        cycle, subInfo = result
+        self.chained.add(process.name)
+        if not subInfo:
+            return None
+        self.manager.subInfo += subInfo
+        self.manager.totalFiles += sum(sub.numberOfFiles for sub in subInfo)
+        if self.target:
+            return None
+        write_cycleInfo(self.workdir,[cycle],self.xmlfile)
+        self.target = MonitorTarget(self.manager,cycle.OutputDirectory,cycle.Cyclename.replace('::','.'),output_tree_name(cycle.Cycle_InputData))
+        self.target.chain = self.next
+        return self.target
+
+#workdir used by more than one stage (the workdir itself being the first one), None if they are all different
+def shared_workdir(workdir,xmlfiles):
+    workdirs = [os.path.normpath(workdir)]
+    for xmlfile in xmlfiles:
+        stageWorkdir = os.path.normpath(fileheader(xmlfile).Workdir or 'workdir')
+        if stageWorkdir in workdirs:
+            return stageWorkdir
+        workdirs.append(stageWorkdir)
+    return None
+
+#stages read from the --chain options, the first one follows the targets of the workdir itself
+def load_chain(options,xmlfiles,scriptpath):
+    stages = [ChainStage(options,xmlfile,scriptpath) for xmlfile in xmlfiles]
+    for stage, nextStage in zip(stages,stages[1:]):
+        stage.next = nextStage
+        if stage.target: stage.target.chain = nextStage
+    return stages
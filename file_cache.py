@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Results of slow file system operations (directory listings, checks of input files) kept between runs in
+# CACHE_DIR. An entry is used as long as the stamp of what it is about (e.g. its mtime) is unchanged and it is
+# younger than the ttl of its cache. Every cache file is written once when sframe_batch exits.
+
+import os
+import time
+import atexit
+import cPickle
+import threading
+
+CACHE_DIR = os.path.expanduser('~/.sframe_batch')
+
+class FileCache(object):
+    def __init__(self,name,ttl,what):
+        self.filename = os.path.join(CACHE_DIR,name)
+        self.ttl = ttl # seconds
+        self.what = what # what is cached, for the messages
+        self.entries = None # key -> (stamp, time it was stored, value), read when first needed
+        self.changed = False
+        self.lock = threading.Lock() # get is also called from threads
+
+    def _load(self):
+        with self.lock:
+            if self.entries is None:
+                self._read()
+
+    def _read(self):
+        self.entries = {}
+        try:
+            with open(self.filename,'rb') as f:
+                entries = cPickle.load(f)
+            #entries written by older versions look different and are dropped
+            self.entries = dict((key,entry) for key,entry in entries.iteritems() if isinstance(entry,tuple) and len(entry) == 3)
+        except Exception:
+            pass
+        atexit.register(self.save)
+
+    #value stored for key with the same stamp, None if there is none or it is too old
+    def get(self,key,stamp):
+        self._load()
+        entry = self.entries.get(key)
+        if entry and entry[0] == stamp and time.time() - entry[1] < self.ttl:
+            return entry[2]
+        return None
+
+    def set(self,key,stamp,value):
+        self._load()
+        self.entries[key] = (stamp,time.time(),value)
+        self.changed = True
+
+    def save(self):
+        if not self.changed:
+            return
+        now = time.time()
+        try:
+            if not os.path.exists(CACHE_DIR):
+                os.makedirs(CACHE_DIR)
+            entries = dict((key,entry) for key,entry in self.entries.iteritems() if now - entry[1] < self.ttl)
+            tmpfile = self.filename+'.'+str(os.getpid())
+            with open(tmpfile,'wb') as f:
+                cPickle.dump(entries,f,cPickle.HIGHEST_PROTOCOL)
+            os.rename(tmpfile,self.filename)
+            self.changed = False
+        except (IOError,OSError) as e:
+            print 'Could not store',self.what,'in',self.filename,e
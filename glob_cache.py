@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Listing big directories on dCache takes seconds, so every glob of SFrameBatch goes through here.
+# A listing is reused as long as the mtime of the directory is unchanged and it is younger than CACHE_TTL.
+# The listings are kept in ~/.sframe_batch/dircache.p so they survive between runs (see file_cache.py).
+
+import os
+import time
+import fnmatch
+from glob import has_magic
+
+from file_cache import FileCache
+
+CACHE_TTL = 3600 # seconds
+
+_listings = FileCache('dircache.p',CACHE_TTL,'directory listings') # directory -> names
+
+#names in a directory, an empty list if it does not exist
+def list_dir(directory):
+    key = os.path.abspath(directory)
+    try:
+        mtime = os.path.getmtime(key)
+    except OSError:
+        return []
+    names = _listings.get(key,mtime)
+    if names is not None:
+        return names
+    try:
+        names = os.listdir(key)
+    except OSError:
+        return []
+    # a file added in the same second would not change the mtime, so recent directories are not kept
+    if time.time() - mtime > 2:
+        _listings.set(key,mtime,names)
+    return names
+
+def _match(directory,pattern,names):
+    if pattern[0] != '.':
+        names = filter(lambda n: n[0] != '.', names)
+    return [os.path.join(directory,n) for n in fnmatch.filter(names,pattern)]
+
+#Same as glob for several patterns at once. Patterns in the same directory share one listing.
+#Returns a dict pattern -> list of matching files.
+def expand_patterns(patterns):
+    results = {}
+    by_dir = {}
+    for pattern in set(patterns):
+        if not has_magic(pattern):
+            results[pattern] = [pattern] if os.path.lexists(pattern) else []
+            continue
+        directory, basename = os.path.split(pattern)
+        by_dir.setdefault(directory,[]).append((pattern,basename))
+    dir_names = filter(has_magic,by_dir)
+    dir_expanded = expand_patterns(dir_names) if dir_names else {}
+    for directory, entries in by_dir.iteritems():
+        dirs = dir_expanded[directory] if directory in dir_expanded else [directory]
+        for pattern, basename in entries:
+            results[pattern] = []
+        for d in dirs:
+            names = None
+            for pattern, basename in entries:
+                if not has_magic(basename):
+                    if os.path.lexists(os.path.join(d,basename)):
+                        results[pattern].append(os.path.join(d,basename))
+                    continue
+                if names is None:
+                    names = list_dir(d or os.curdir)
+                results[pattern] += _match(d,basename,names)
+    return results
+
+def cached_glob(pattern):
+    return expand_patterns([pattern])[pattern]
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Used with --checkInputs: before any xml file is written all input files are checked, many at the same time.
+# Files that are missing, empty, not readable or only on tape (dCache NEARLINE) are taken out of the InputData
+# and listed in bad_inputs.txt in the workdir, so that no job is sent to the batch to fail on them.
+# Results are kept in ~/.sframe_batch/inputcheck.p (see file_cache.py) and reused as long as the file did not
+# change and they are younger than CACHE_TTL.
+# Files given as URL (root://, dcap://) are not checked.
+
+import os
+from multiprocessing.pool import ThreadPool
+
+from file_cache import FileCache
+
+CACHE_TTL = 3600 # seconds
+CHECK_THREADS = 16
+
+_results = FileCache('inputcheck.p',CACHE_TTL,'the checked input files') # filename -> problem
+
+#dCache tells with a special file name where a file is, ONLINE (disk), NEARLINE (tape) or both
+def _locality(filename):
+    directory, name = os.path.split(filename)
+    try:
+        with open(os.path.join(directory,'.(get)('+name+')(locality)')) as f:
+            return f.read().strip()
+    except (IOError,OSError):
+        return ''
+
+def _check(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return filename, None, 'missing'
+    key = (stat.st_mtime,stat.st_size)
+    cached = _results.get(filename,key)
+    if cached is not None:
+        return filename, None, cached
+    problem = ''
+    if stat.st_size == 0:
+        problem = 'empty'
+    elif filename.startswith('/pnfs/') and 'ONLINE' not in (_locality(filename) or 'ONLINE'):
+        problem = 'only on tape'
+    else:
+        try:
+            with open(filename,'rb') as f:
+                if f.read(4) != 'root':
+                    problem = 'not a root file'
+        except IOError as e:
+            problem = 'not readable ('+str(e)+')'
+    return filename, key, problem
+
+#problem of each file, '' if it is fine
+def check_files(filenames,threads=CHECK_THREADS):
+    filenames = [f for f in set(filenames) if f and '://' not in f]
+    if not filenames:
+        return {}
+    pool = ThreadPool(min(threads,len(filenames)))
+    problems = {}
+    for filename, key, problem in pool.map(_check,filenames):
+        problems[filename] = problem
+        if key:
+            _results.set(filename,key,problem)
+    pool.close()
+    return problems
+
+#takes all bad files out of the InputData of Job, they are listed in workdir/bad_inputs.txt
+def check_inputs(Job,workdir):
+    inputdatas = [inputdata for cycle in Job.Job_Cylce for inputdata in cycle.Cycle_InputData]
+    filenames = []
+    for inputdata in inputdatas:
+        FileInfoList = inputdata.io_list.FileInfoList
+        filenames += [FileInfoList.filename(i) for i in xrange(len(FileInfoList))]
+    problems = check_files(filenames)
+    bad = []
+    for inputdata in inputdatas:
+        FileInfoList = inputdata.io_list.FileInfoList
+        badIndices = [i for i in xrange(len(FileInfoList)) if problems.get(FileInfoList.filename(i))]
+        bad += [(inputdata.Version,FileInfoList.filename(i)) for i in badIndices]
+        FileInfoList.remove_indices(badIndices)
+    print 'Checked',len(problems),'input files,',len(bad),'of them can not be used'
+    with open(workdir+'/bad_inputs.txt','w') as f:
+        for version, filename in bad:
+            print '  ',version,filename,problems[filename]
+            f.write(version+' '+filename+' '+problems[filename]+'\n')
+    return len(bad)
@@ -9,17 +9,21 @@
 from xml.dom.minidom import parse, parseString
 from xml.dom.minidom import Document
 import xml.sax
+from xml.sax.saxutils import escape
 
 import math
+import bisect
 import time
-import ROOT
 import copy
+import re
+import cPickle
+from glob_cache import cached_glob
 
 #my classes
 from Inf_Classes import *
 from batch_classes import *
 
-def write_job(Job,Version=-1,SkipEvents=0,MaxEvents=-1,NFile=None, FileSplit=-1,workdir="workdir",LumiWeight=1):
+def write_job(Job,Version=-1,SkipEvents=0,MaxEvents=-1,NFile=None, FileSplit=-1,workdir="workdir",LumiWeight=1,FileRange=None):
     doc = Document()
     root = doc.createElement("JobConfiguration")
     root.setAttribute( 'JobName', Job.JobName)
@@ -79,13 +83,14 @@ def write_job(Job,Version=-1,SkipEvents=0,MaxEvents=-1,NFile=None, FileSplit=-1,
                 InputGrandchild.setAttribute('NEventsSkip', str(SkipEvents))
                 InputGrandchild.setAttribute('NEventsMax', str(MaxEvents))
         
-            count_i =-1
             #print len(cycle.Cycle_InputData[p].io_list)
-            for entry in cycle.Cycle_InputData[p].io_list.FileInfoList:
-                count_i +=1
-                if FileSplit > 0:
-                    if not (count_i<(NFile+1)*FileSplit and count_i>= NFile*FileSplit):
-                        continue
+            FileInfoList = cycle.Cycle_InputData[p].io_list.FileInfoList
+            if FileSplit > 0:
+                FileInfoList = FileInfoList[NFile*FileSplit:(NFile+1)*FileSplit]
+            elif FileRange:
+                # only the files with the events of the job, SkipEvents counts from the first of them
+                FileInfoList = FileInfoList[FileRange[0]:FileRange[1]+1]
+            for entry in FileInfoList:
                 Datachild= doc.createElement(entry[0])
                 InputGrandchild.appendChild(Datachild)
                 for it in range(1,len(entry),2):
@@ -130,6 +135,16 @@ class fileheader(object):
         self.AutoResubmit =0
         self.MaxJobsPerProcess = -1
         self.RemoveEmptyFileSplit = False
+        self.NotFoundTimeout = 120 # seconds a job has to be missing on the batch before it is treated as dead
+        self.Stage = False # copy inputs and outputs through the local disk of the node
+        self.StageParallel = 4 # number of input files copied at the same time
+        self.Manifest = False # one manifest per process instead of an xml file per job
+        self.Resplit = 0 # number of parts a failing job is split into, 0 to never split
+        self.ResplitAfter = 2 # number of failures before a job is split
+        self.Speculate = 0 # a copy of a job is started when it runs this many times longer than the median job, 0 to never do it
+        self.Heartbeat = False # jobs write heartbeats into the workdir, qstat is only needed for jobs that did not start
+        self.MemoStore = '' # directory with the outputs of earlier jobs, a job found there is not run again
+        self.AutoResources = 0 # margin on the memory and run time finished jobs of a process used, 0 to request RAM and 3h
         while '<JobConfiguration' not in line:
             self.header.append(line)
             line = f.readline()
@@ -143,6 +158,16 @@ class fileheader(object):
                     self.MaxJobsPerProcess = int(self.ConfigParse.attributes['MaxJobsPerProcess'].value)
                 if self.ConfigParse.hasAttribute('RemoveEmptyFileSplit'):
                     self.RemoveEmptyFileSplit = bool(self.ConfigParse.attributes['RemoveEmptyFileSplit'].value)
+                if self.ConfigParse.hasAttribute('NotFoundTimeout'):
+                    self.NotFoundTimeout = float(self.ConfigParse.attributes['NotFoundTimeout'].value)
+                if self.ConfigParse.hasAttribute('Resplit'):
+                    self.Resplit = int(self.ConfigParse.attributes['Resplit'].value)
+                if self.ConfigParse.hasAttribute('ResplitAfter'):
+                    self.ResplitAfter = int(self.ConfigParse.attributes['ResplitAfter'].value)
+                if self.ConfigParse.hasAttribute('Speculate'):
+                    self.Speculate = float(self.ConfigParse.attributes['Speculate'].value)
+                if self.ConfigParse.hasAttribute('Manifest'):
+                    self.Manifest = self.ConfigParse.attributes['Manifest'].value.lower() in ('true','1')
 
             if 'ConfigSGE' in line:
                 self.ConfigSGE = parseString(line).getElementsByTagName('ConfigSGE')[0]
@@ -151,47 +176,158 @@ class fileheader(object):
                 self.Notification = self.ConfigSGE.attributes['Notification'].value
                 self.Mail = self.ConfigSGE.attributes['Mail'].value
                 self.Workdir = self.ConfigSGE.attributes['Workdir'].value
+                if self.ConfigSGE.hasAttribute('Stage'):
+                    self.Stage = self.ConfigSGE.attributes['Stage'].value.lower() in ('true','1')
+                if self.ConfigSGE.hasAttribute('StageParallel'):
+                    self.StageParallel = int(self.ConfigSGE.attributes['StageParallel'].value)
+                if self.ConfigSGE.hasAttribute('Heartbeat'):
+                    self.Heartbeat = self.ConfigSGE.attributes['Heartbeat'].value.lower() in ('true','1')
+                if self.ConfigSGE.hasAttribute('MemoStore'):
+                    self.MemoStore = os.path.expanduser(self.ConfigSGE.attributes['MemoStore'].value)
+                if self.ConfigSGE.hasAttribute('AutoResources'):
+                    self.AutoResources = float(self.ConfigSGE.attributes['AutoResources'].value)
         f.close()   
 
+#xml file and all entity files it references, the entities are declared in the header
+def get_config_files(xmlfile,header):
+    xmldir = os.path.dirname(os.path.abspath(xmlfile))
+    files = [os.path.abspath(xmlfile)]
+    for line in header.header:
+        for entity in re.findall(r'<!ENTITY\s+\S+\s+SYSTEM\s+"([^"]*)"',line):
+            files.append(os.path.join(xmldir,entity))
+    return files
+
+#modification times of the files and of the directories used in wildcards
+def get_config_mtimes(files,patterns):
+    mtimes = {}
+    for name in files:
+        mtimes[name] = os.path.getmtime(name) if os.path.exists(name) else -1
+    for pattern in patterns:
+        for directory in cached_glob(os.path.dirname(pattern)):
+            mtimes[directory] = os.path.getmtime(directory)
+    return mtimes
+
+def get_config_patterns(Job):
+    patterns = []
+    for cycle in Job.Job_Cylce:
+        for inputdata in cycle.Cycle_InputData:
+            patterns += inputdata.FilePatterns
+    return patterns
+
+#the parsed JobConfig is kept in the workdir, it is used as long as none of the files changed
+JOBCONFIG_CACHE_VERSION = 2 # increase whenever the pickled classes change
+
+def load_jobconfig_cache(xmlfile,header,workdir):
+    cachefile = workdir+'/JobConfigCache.p'
+    if not os.path.isfile(cachefile):
+        return None
+    try:
+        with open(cachefile,'rb') as f:
+            cache = cPickle.load(f)
+    except Exception as e:
+        print 'Could not read',cachefile,e
+        return None
+    if cache.get('version') != JOBCONFIG_CACHE_VERSION:
+        return None
+    files = get_config_files(xmlfile,header)
+    if sorted(files) != sorted(cache['files']):
+        return None
+    if get_config_mtimes(files,get_config_patterns(cache['job'])) != cache['mtimes']:
+        return None
+    print 'Using parsed config from',cachefile
+    return cache['job']
+
+def save_jobconfig_cache(Job,xmlfile,header,workdir):
+    cachefile = workdir+'/JobConfigCache.p'
+    files = get_config_files(xmlfile,header)
+    cache = {'version':JOBCONFIG_CACHE_VERSION,'files':files,'mtimes':get_config_mtimes(files,get_config_patterns(Job)),'job':Job}
+    try:
+        with open(cachefile+'.tmp','wb') as f:
+            cPickle.dump(cache,f,cPickle.HIGHEST_PROTOCOL)
+        os.rename(cachefile+'.tmp',cachefile)
+    except IOError as e:
+        print "I/O error({0}): {1}".format(e.errno, e.strerror)
+
 def get_number_of_events(Job, Version, atleastOneEvent = False):
     InputData = filter(lambda inp: inp.Version==Version[0], Job.Job_Cylce[0].Cycle_InputData)[0]
     NEvents = 0
-    if len(InputData.io_list.FileInfoList[:])<5:
+    emptyFiles = [] # removed in one go, removing them one by one is slow for long lists
+    if not hasattr(InputData.io_list,'Entries'): InputData.io_list.Entries = {}
+    knownEntries = InputData.io_list.Entries # given in the config, e.g. by the Result.xml of the stage before
+    if len(InputData.io_list.FileInfoList)<5:
         atleastOneEvent=False
-    for entry in InputData.io_list.FileInfoList[:]:
+    for i, entry in enumerate(InputData.io_list.FileInfoList):
             for name in entry:
-                if name.endswith('.root'):
+                if name.endswith('.root') and name in knownEntries:
+                    if knownEntries[name] < 1:
+                        emptyFiles.append(i)
+                        break
+                    NEvents += knownEntries[name]
+                    if atleastOneEvent:
+                        InputData.io_list.FileInfoList.remove_indices(emptyFiles)
+                        return 1
+                elif name.endswith('.root'):
+                    ROOT = load_ROOT()
                     f = ROOT.TFile(name)
                     try:
                         n = f.Get(str(InputData.io_list.InputTree[2])).GetEntriesFast()
+                        knownEntries[name] = n
                         if n < 1:
-                            InputData.io_list.FileInfoList.remove(entry)
+                            emptyFiles.append(i)
+                            f.Close()
                             break
                         else:
                             NEvents += n
                             if atleastOneEvent: 
                                 f.Close()
+                                InputData.io_list.FileInfoList.remove_indices(emptyFiles)
                                 return 1
                     except:
                         print name,'does not contain an InputTree'
                     f.Close()
+    InputData.io_list.FileInfoList.remove_indices(emptyFiles)
     return NEvents
 
-def write_all_xml(path,datasetName,header,Job,workdir):
+#entries of each file of the InputData of Version as known after get_number_of_events, None if one is unknown
+def get_file_entries(Job,Version):
+    InputData = filter(lambda inp: inp.Version==Version[0], Job.Job_Cylce[0].Cycle_InputData)[0]
+    knownEntries = getattr(InputData.io_list,'Entries',{})
+    counts = []
+    for i in xrange(len(InputData.io_list.FileInfoList)):
+        name = InputData.io_list.FileInfoList.filename(i)
+        if name not in knownEntries:
+            return None
+        counts.append(knownEntries[name])
+    return counts
+
+#how one process is split into jobs, for each job the xml name suffix and the arguments of write_job.
+#Computing it needs the number of events, writing it is cheap and can be done for several workdirs.
+class JobPlan(object):
+    def __init__(self,Version):
+        self.Version = Version
+        self.jobs = [] # (suffix, SkipEvents, MaxEvents, NFile, FileSplit, LumiWeight, FileRange)
+
+    def add(self,suffix,SkipEvents=0,MaxEvents=-1,NFile=None,FileSplit=-1,LumiWeight=1,FileRange=None):
+        self.jobs.append((suffix,SkipEvents,MaxEvents,NFile,FileSplit,LumiWeight,FileRange))
+
+    def __len__(self):
+        return len(self.jobs)
+
+def plan_jobs(datasetName,header,Job):
     NEventsBreak= header.NEventsBreak
     FileSplit=header.FileSplit
     FileSplitCompleteRemove = header.RemoveEmptyFileSplit
     MaxJobs = header.MaxJobsPerProcess
-    NFiles=0
 
     Version =datasetName
     if Version[0] =='-1':Version =-1
+    plan = JobPlan(Version)
 
     if NEventsBreak!=0 and FileSplit<=0:
         NEvents = get_number_of_events(Job, Version)
         if NEvents<=0: 
             print Version[0],'has no InputTree'
-            return NFiles
+            return plan
         print '%s: %i events' % (Version[0], NEvents)
         NFiles = int(math.ceil(NEvents / float(NEventsBreak)))
         if NFiles > MaxJobs and MaxJobs > 0:
@@ -200,6 +336,12 @@ def write_all_xml(path,datasetName,header,Job,workdir):
             NEventsBreak = int(math.ceil(NEvents/float(MaxJobs)))
         SkipEvents = NEventsBreak
         MaxEvents = NEventsBreak   
+        #first event of every file, a job then only needs the files its events are in
+        counts = get_file_entries(Job,Version)
+        starts = None
+        if counts:
+            starts = [0]
+            for n in counts[:-1]: starts.append(starts[-1]+n)
 
         for i in xrange(NFiles):
             if i*SkipEvents >= NEvents:
@@ -207,11 +349,12 @@ def write_all_xml(path,datasetName,header,Job,workdir):
             if (i+1)*MaxEvents >= NEvents:
                 MaxEvents = NEvents-i*SkipEvents
             LumiWeight = float(NEvents)/float(MaxEvents)
-            outfile = open(path+'_'+str(i+1)+'.xml','w+')
-            for line in header.header:
-                outfile.write(line)
-            outfile.write(write_job(Job,Version,i*SkipEvents,MaxEvents,i,-1,workdir,LumiWeight))
-            outfile.close()
+            FileRange = None
+            Skip = i*SkipEvents
+            if starts:
+                FileRange = (bisect.bisect_right(starts,Skip)-1,bisect.bisect_left(starts,Skip+MaxEvents)-1)
+                Skip -= starts[FileRange[0]]
+            plan.add(str(i+1),Skip,MaxEvents,i,-1,LumiWeight,FileRange)
  
     elif FileSplit>0:
         for entry in Version:
@@ -233,22 +376,174 @@ def write_all_xml(path,datasetName,header,Job,workdir):
                             print 'New number of Jobs',numberOfJobs,'Number of xml-Files per Job',numberOfSplits
 
                         for it in range(numberOfJobs):
-                            outfile = open(path+'_'+str(it+1)+'.xml','w+')
-                            for line in header.header:
-                                outfile.write(line)
-                            outfile.write(write_job(Job,Version,0,-1,it,numberOfSplits,workdir))
-                            outfile.close()
-                            NFiles+=1
+                            plan.add(str(len(plan)+1),0,-1,it,numberOfSplits)
     else:
-        NFiles+=1
-        outfile = open(path+'_OneCore'+'.xml','w+')
-        for line in header.header:
-            outfile.write(line)
-        outfile.write(write_job(Job,Version,0,-1,"",0,workdir))
+        plan.add('OneCore',0,-1,"",0)
+
+    return plan
+
+#content of the xml file of one job of a plan
+def job_xml(headerLines,Job,Version,job,workdir):
+    suffix, SkipEvents, MaxEvents, NFile, FileSplit, LumiWeight = job[:6]
+    FileRange = job[6] if len(job) > 6 else None # not in manifests written by older versions
+    return ''.join(headerLines)+write_job(Job,Version,SkipEvents,MaxEvents,NFile,FileSplit,workdir,LumiWeight,FileRange)
+
+#writes the xml files of a plan, the UserConfig and OutputDirectory are taken from Job as they are now
+def write_plan(path,plan,header,Job,workdir):
+    if header.Manifest:
+        return write_manifest(path,plan,header,Job,workdir)
+    for job in plan.jobs:
+        outfile = open(path+'_'+job[0]+'.xml','w+')
+        outfile.write(job_xml(header.header,Job,plan.Version,job,workdir))
         outfile.close()
+    return len(plan)
+
+#Job with only the InputData of Version, all that is needed to write the xml files of a process
+def prune_job(Job,Version):
+    pruned = copy.copy(Job)
+    pruned.Job_Cylce = []
+    for cycle in Job.Job_Cylce:
+        prunedCycle = copy.copy(cycle)
+        prunedCycle.Cycle_InputData = [inputdata for inputdata in cycle.Cycle_InputData if Version == -1 or inputdata.Version in Version]
+        pruned.Job_Cylce.append(prunedCycle)
+    return pruned
+
+#Instead of one xml file per job a single path.manifest with the pruned Job and the plan is written.
+#batch_job.py creates the xml file of a task from it when the task runs.
+MANIFEST_VERSION = 1
+
+def write_manifest(path,plan,header,Job,workdir):
+    manifest = {'version':MANIFEST_VERSION,'header':header.header,'Job':prune_job(Job,plan.Version),
+                'Version':plan.Version,'jobs':plan.jobs,'workdir':workdir}
+    # done here once, the tasks running at the same time should not all try to create it
+    for cycle in Job.Job_Cylce:
+        if not os.path.exists(cycle.OutputDirectory+'/'+workdir+'/') and "__NOTSET__" not in cycle.OutputDirectory:
+            os.makedirs(cycle.OutputDirectory+'/'+workdir+'/')
+    with open(path+'.manifest.tmp','wb') as f:
+        cPickle.dump(manifest,f,cPickle.HIGHEST_PROTOCOL)
+    os.rename(path+'.manifest.tmp',path+'.manifest')
+    return len(plan)
+
+def read_manifest_xml(manifestfile,suffix):
+    with open(manifestfile,'rb') as f:
+        manifest = cPickle.load(f)
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError('Unknown manifest version in '+manifestfile)
+    for job in manifest['jobs']:
+        if job[0] == suffix:
+            return job_xml(manifest['header'],manifest['Job'],manifest['Version'],job,manifest['workdir'])
+    raise ValueError('No task '+suffix+' in '+manifestfile)
+
+def write_all_xml(path,datasetName,header,Job,workdir):
+    return write_plan(path,plan_jobs(datasetName,header,Job),header,Job,workdir)
 
-    return NFiles
 
+#Replaces the wildcard of process name in Result.xml by its output files, each followed by a comment with its
+#number of entries. get_number_of_events takes them from there instead of opening the files again.
+def write_result_entries(path,name,files,entries):
+    resultfile = path+'/Result.xml'
+    if not os.path.exists(resultfile):
+        return False
+    wildcard = re.compile(r'FileName="([^"]*\.'+re.escape(name)+r'_\*\.root)"')
+    lines = []
+    found = False
+    for line in open(resultfile):
+        match = wildcard.search(line)
+        if not match or not line.strip().startswith('<In'):
+            lines.append(line)
+            continue
+        found = True
+        for filename, nentries in zip(files,entries):
+            lines.append(line.rstrip().replace(match.group(1),escape(filename,{'"':'&quot;'}))+'<!-- NEntries="%i" -->\n' % nentries)
+    if found:
+        with open(resultfile+'.tmp','w') as f:
+            f.writelines(lines)
+        os.rename(resultfile+'.tmp',resultfile)
+    return found
+
+
+#xml of a task, from its xml file or the manifest of the process
+def job_text(workdir,name,task):
+    if os.path.exists(workdir+'/'+name+'_'+task+'.xml'):
+        return open(workdir+'/'+name+'_'+task+'.xml').read()
+    elif os.path.exists(workdir+'/'+name+'.manifest'):
+        return read_manifest_xml(workdir+'/'+name+'.manifest',task)
+    return None
+
+#Copy of a task writing its output into the speculative directory next to the output of the job.
+#Returns the name of the copy, nothing if there is no xml for the task.
+def speculative_job(workdir,name,task):
+    text = job_text(workdir,name,task)
+    if not text:
+        return None
+    outputdirs = re.findall(r'<Cycle\s[^>]*?OutputDirectory="([^"]*)"',text)
+    for outputdir in outputdirs:
+        if not os.path.exists(outputdir+'speculative/'):
+            os.makedirs(outputdir+'speculative/')
+    text = re.sub(r'(<Cycle\s[^>]*?OutputDirectory="[^"]*)(")',r'\1speculative/\2',text)
+    specName = name+'_'+task+'_spec'
+    outfile = open(workdir+'/'+specName+'.xml','w+')
+    outfile.write(text)
+    outfile.close()
+    return specName
+
+#xml document without the whitespace of the pretty printing, so that it can be pretty printed again
+def _parse_job(body):
+    doc = parseString(body)
+    nodes = [doc.documentElement]
+    while nodes:
+        node = nodes.pop()
+        for child in list(node.childNodes):
+            if child.nodeType == child.TEXT_NODE and not child.data.strip():
+                node.removeChild(child)
+            else:
+                nodes.append(child)
+    return doc
+
+#Splits the job of a task that keeps failing into up to nParts jobs with fewer events or fewer files.
+#The parts write their output with the PostFix _part<j>, the JobManager combines them afterwards.
+#Returns the names of the parts, nothing if the job can not be split.
+def resplit_job(workdir,name,task,nParts):
+    text = job_text(workdir,name,task)
+    if not text:
+        return []
+    prefix = text[:text.index('<JobConfiguration')]
+    body = text[text.index('<JobConfiguration'):]
+    inputdata = _parse_job(body).getElementsByTagName('InputData')
+    if len(inputdata) != 1:
+        return []
+    inputdata = inputdata[0]
+    slices = []
+    NFiles = len(inputdata.getElementsByTagName('In'))
+    if inputdata.hasAttribute('NEventsMax') and int(inputdata.getAttribute('NEventsMax')) > 0:
+        SkipEvents = int(inputdata.getAttribute('NEventsSkip') or 0)
+        MaxEvents = int(inputdata.getAttribute('NEventsMax'))
+        step = int(math.ceil(MaxEvents/float(nParts)))
+        slices = [(SkipEvents+j*step,min(step,MaxEvents-j*step)) for j in xrange(nParts) if j*step < MaxEvents]
+    elif NFiles > 1:
+        step = int(math.ceil(NFiles/float(nParts)))
+        slices = [(j*step,min((j+1)*step,NFiles)) for j in xrange(nParts) if j*step < NFiles]
+    if len(slices) < 2:
+        return []
+
+    names = []
+    for j, (first, second) in enumerate(slices):
+        part = _parse_job(body)
+        partInput = part.getElementsByTagName('InputData')[0]
+        if inputdata.hasAttribute('NEventsMax') and int(inputdata.getAttribute('NEventsMax')) > 0:
+            partInput.setAttribute('NEventsSkip',str(first))
+            partInput.setAttribute('NEventsMax',str(second))
+        else:
+            for n, entry in enumerate(partInput.getElementsByTagName('In')):
+                if n < first or n >= second:
+                    partInput.removeChild(entry)
+        for cycle in part.getElementsByTagName('Cycle'):
+            cycle.setAttribute('PostFix',cycle.getAttribute('PostFix')+'_part'+str(j+1))
+        names.append(name+'_'+task+'_part'+str(j+1))
+        outfile = open(workdir+'/'+names[-1]+'.xml','w+')
+        outfile.write(prefix+part.documentElement.toprettyxml())
+        outfile.close()
+    return names
 
 def result_info(Job, path, header, other = []):
     #get a xml file with all the infomartion that you need to proced
@@ -271,7 +566,7 @@ def result_info(Job, path, header, other = []):
             if len(inputdata.io_list.FileInfoList)==0:
                 continue
 
-            inputdata.io_list.FileInfoList = [['In','Lumi',inputdata.io_list.FileInfoList[0][2],'FileName',cycle.OutputDirectory+"/"+path+"/uhh2.AnalysisModuleRunner.*."+inputdata.Version+"_*.root"]]   
+            inputdata.io_list.FileInfoList = CompactFileList([['In','Lumi',inputdata.io_list.FileInfoList[0][2],'FileName',cycle.OutputDirectory+"/"+path+"/uhh2.AnalysisModuleRunner.*."+inputdata.Version+"_*.root"]])
             inputdata.io_list.InputTree  =['InputTree','Name',inputdata.io_list.other[other_index][2]]
             if not other:
                 inputdata.io_list.other = []
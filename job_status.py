@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Jobs started through batch_job.py with --heartbeat write <jobid>.run into STATUS_DIR of the workdir when they
+# start, touch it every HEARTBEAT_INTERVAL seconds while sframe_main runs and write <jobid>.exit with the exit
+# code and the used time when they are finished. The JobManager reads all of them with one listing of the
+# directory, qstat is then only needed for jobs that did not start yet.
+# jobids are 'pid.task' for tasks of array jobs and 'pid' for single jobs, as in SubInfo.job_id.
+
+import os
+import json
+import time
+import socket
+import threading
+
+STATUS_DIR = 'JobStatus'
+HEARTBEAT_INTERVAL = 30 # seconds
+HEARTBEAT_TIMEOUT = 300 # seconds without heartbeat after which a job is dead, the mtime on network file systems lags
+
+#id of the job running this process, None outside of the batch
+def current_job_id():
+    pid = os.environ.get('JOB_ID')
+    if not pid:
+        return None
+    task = os.environ.get('SGE_TASK_ID','undefined')
+    if task in ('','undefined'):
+        return pid
+    return pid+'.'+task
+
+def write_record(filename,record):
+    tmpfile = filename+'.'+str(os.getpid())
+    with open(tmpfile,'w') as f:
+        json.dump(record,f)
+    os.rename(tmpfile,filename)
+
+#writes the start record, keeps the heartbeat going while run is called and writes the exit record afterwards
+def run_with_heartbeat(statusdir,run):
+    jobid = current_job_id()
+    if not jobid:
+        print 'Not running on the batch, no heartbeat written'
+        return run()
+    if not os.path.exists(statusdir):
+        try:
+            os.makedirs(statusdir)
+        except OSError:
+            if not os.path.isdir(statusdir): raise
+    runfile = os.path.join(statusdir,jobid+'.run')
+    start = time.time()
+    write_record(runfile,{'start':start,'host':socket.gethostname()})
+    stop = threading.Event()
+    def beat():
+        while not stop.wait(HEARTBEAT_INTERVAL):
+            try:
+                os.utime(runfile,None)
+            except OSError as e:
+                print 'Heartbeat failed',e
+    heartbeat = threading.Thread(target=beat)
+    heartbeat.daemon = True
+    heartbeat.start()
+    returncode = 1
+    try:
+        returncode = run()
+    finally:
+        stop.set()
+        heartbeat.join()
+        times = os.times()
+        write_record(os.path.join(statusdir,jobid+'.exit'),{'exit':returncode,'start':start,'end':time.time(),'cpu':times[2]+times[3]})
+    return returncode
+
+#status of the jobs of a workdir from their records, read once per check of the jobs
+class statusWatcher(object):
+    def __init__(self,workdir):
+        self.statusdir = os.path.join(workdir,STATUS_DIR)
+        self.heartbeats = {} # jobid -> time of the last heartbeat
+        self.exits = {} # jobid -> exit record, they do not change anymore
+
+    def update(self):
+        self.heartbeats = {}
+        try:
+            names = os.listdir(self.statusdir)
+        except OSError:
+            return
+        for name in names:
+            jobid, dot, kind = name.rpartition('.')
+            try:
+                if kind == 'run':
+                    self.heartbeats[jobid] = os.path.getmtime(os.path.join(self.statusdir,name))
+                elif kind == 'exit' and jobid not in self.exits:
+                    with open(os.path.join(self.statusdir,name)) as f:
+                        self.exits[jobid] = json.load(f)
+            except (IOError,OSError,ValueError):
+                pass # removed or still written, next time
+
+    #1 if the job is running, 0 if it finished or died, None if there is no record of it
+    def check_status(self,jobid):
+        if jobid in self.exits:
+            return 0
+        if jobid in self.heartbeats:
+            return 1 if time.time() - self.heartbeats[jobid] < HEARTBEAT_TIMEOUT else 0
+        return None
+
+    #True if the job wrote its exit record, a job whose heartbeat stopped might still run
+    def exited(self,jobid):
+        return jobid in self.exits
+
+    #True if the job finished with an exit code other than 0 or stopped its heartbeat
+    def failed(self,jobid):
+        if jobid in self.exits:
+            return self.exits[jobid].get('exit') != 0
+        return self.check_status(jobid) == 0
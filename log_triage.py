@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Looks through the logs of the jobs in the Stream_ directories of a workdir for known error messages, such that a
+# job failing for a reason that does not go away (a broken config, a missing input file) is not resubmitted again.
+# Failures are transient, resource or fatal, only fatal ones are not resubmitted. The last known message in a log
+# decides, the error log (.e) of a job before its output log (.o). Jobs without a known message count as transient.
+# Fatal are only terminal messages of SFrame and ROOT, generic ones like 'No such file or directory' show up in
+# harmless noise of the environment and in dCache errors that go away.
+# Only the bytes added since the last scan are read, the position in every log is kept in INDEX_FILE in the workdir.
+
+import os
+import re
+import json
+from multiprocessing.pool import ThreadPool
+
+INDEX_FILE = 'LogIndex.p'
+SCAN_THREADS = 8
+
+#logs written by SGE, <script>.o<pid>.<task> for array jobs and <script>.o<pid> for single jobs
+LOG_NAME = re.compile(r'\.([oe])(\d+)(?:\.(\d+))?$')
+
+SIGNATURES = [
+    ('resource', re.compile(r'std::bad_alloc|out of memory|cannot allocate memory|exceeded (the )?(memory|time) limit|h_vmem|h_rt|CPU time limit exceeded|No space left on device',re.I)),
+    ('fatal', re.compile(r'SError.*StopExecution|SCycleController.*(Failed|not found|Unknown)|Failed to load library|Error in <TUnixSystem::(Load|DynamicPathName)>|Error in <TDOMParser|XML parse error')),
+    ('transient', re.compile(r'TNetXNGFile|dcap|Input/output error|Connection (refused|timed out|reset)|Server responded with an error|Socket error|Stale file handle|Network is unreachable',re.I)),
+    ]
+
+#class of the last known message in the part of a log after offset, '' if there is none. Only complete lines are read
+def scan_log(args):
+    path, offset = args
+    last = ''
+    position = -1
+    try:
+        with open(path) as f:
+            f.seek(offset)
+            text = f.read()
+    except (IOError,OSError):
+        return path, offset, last
+    end = text.rfind('\n')+1
+    for name, signature in SIGNATURES:
+        for match in signature.finditer(text,0,end):
+            if match.start() > position:
+                last, position = name, match.start()
+    return path, offset+end, last
+
+class LogIndex(object):
+    def __init__(self,workdir):
+        self.workdir = workdir
+        self.indexfile = os.path.join(workdir,INDEX_FILE)
+        self.logs = {} # path -> [bytes read, class of the last known message]
+        self.jobs = {} # jobid as in delete_jobs -> {'o' or 'e': class of the last message in that log}
+        try:
+            with open(self.indexfile) as f:
+                self.logs = json.load(f)
+        except (IOError,ValueError):
+            pass
+        for path, entry in self.logs.items():
+            if isinstance(entry[1],list):
+                self.logs[path] = [entry[0],''] # written by an older version, only read on
+        self.update_jobs()
+
+    #reads whatever was added to the logs since the last scan, several logs at the same time
+    def scan(self):
+        todo = []
+        for stream in os.listdir(self.workdir):
+            if not stream.startswith('Stream_') or not os.path.isdir(os.path.join(self.workdir,stream)):
+                continue
+            for name in os.listdir(os.path.join(self.workdir,stream)):
+                if not LOG_NAME.search(name):
+                    continue
+                path = os.path.join(self.workdir,stream,name)
+                offset = self.logs.get(path,[0,''])[0]
+                if os.path.getsize(path) > offset:
+                    todo.append((path,offset))
+        if not todo:
+            return
+        pool = ThreadPool(min(SCAN_THREADS,len(todo)))
+        for path, offset, last in pool.map(scan_log,todo):
+            self.logs[path] = [offset,last or self.logs.get(path,[0,''])[1]]
+        pool.close()
+        self.update_jobs()
+        try:
+            with open(self.indexfile,'w') as f:
+                json.dump(self.logs,f)
+        except IOError as e:
+            print 'Could not store the log index in',self.indexfile,e
+
+    def update_jobs(self):
+        self.jobs = {}
+        for path, (offset, name) in self.logs.iteritems():
+            stream, pid, task = LOG_NAME.search(path).groups()
+            if name:
+                self.jobs.setdefault(pid+'.'+task if task else pid,{})[stream] = name
+
+    #transient, resource or fatal for the job from its last known message, '' if nothing is known
+    def classify(self,jobid):
+        last = self.jobs.get(jobid,{})
+        return last.get('e') or last.get('o') or ''
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Store of job outputs shared between workdirs, used with MemoStore="dir" in ConfigSGE. The key of a job is the
+# hash of its xml file (without the header and the output directory) and of the analysis libraries it loads.
+# A job whose key is already in the store is not run, its output is copied into the workdir instead.
+# The outputs of all other jobs are added to the store once they are there and can be opened, with -l this is
+# done in the file worker of the monitor loop.
+
+import os
+import re
+import shutil
+import hashlib
+from xml.sax.saxutils import unescape
+
+from tree_checker import check_FileReadable
+
+MEMO_DIR = 'Memoized' # marker per task in the workdir, the batch script does not run the marked tasks
+
+CYCLE_OUTPUTDIR = re.compile(r'(<Cycle\s[^>]*?OutputDirectory=")([^"]*)(")')
+LIBRARY = re.compile(r'<Library\s[^>]*?Name="([^"]*)"')
+ATTRIBUTE = re.compile(r'(\w+)="([^"]*)"')
+
+_libraries = {} # path -> hash, every library is read once per run
+_missing = set() # libraries that were not found, each is reported once
+
+#hash of the library as found in the library path, None if it is not found
+def library_hash(name):
+    dirs = os.environ.get('LD_LIBRARY_PATH','').split(':')+[os.environ.get('SFRAME_LIB_PATH','')]
+    for directory in filter(None,dirs):
+        for path in (os.path.join(directory,name),os.path.join(directory,name+'.so')):
+            if not os.path.isfile(path):
+                continue
+            if path not in _libraries:
+                sha = hashlib.sha1()
+                with open(path,'rb') as f:
+                    for block in iter(lambda: f.read(1<<20),''):
+                        sha.update(block)
+                _libraries[path] = sha.hexdigest()
+            return _libraries[path]
+    return None
+
+#key of the job with xml text, None if it can not be memoized because a library was not found
+def job_key(text):
+    body = text[text.find('<JobConfiguration'):]
+    sha = hashlib.sha1(CYCLE_OUTPUTDIR.sub(r'\1\3',body))
+    for name in LIBRARY.findall(body):
+        libraryHash = library_hash(name)
+        if not libraryHash:
+            if name not in _missing:
+                _missing.add(name)
+                print 'Library',name,'not found, the jobs using it are not memoized'
+            return None
+        sha.update(libraryHash)
+    return sha.hexdigest()
+
+#file written by sframe_main for the job with xml text
+def output_file(text):
+    cycle = dict(ATTRIBUTE.findall(re.search(r'<Cycle\s[^>]*>',text).group(0)))
+    inputdata = dict(ATTRIBUTE.findall(re.search(r'<InputData\s[^>]*>',text).group(0)))
+    name = cycle['Name'].replace('::','.')+'.'+inputdata['Type']+'.'+inputdata['Version']+cycle.get('PostFix','')+'.root'
+    return os.path.join(unescape(cycle['OutputDirectory']),unescape(name))
+
+def store_path(store,key):
+    return os.path.join(store,key[:2],key+'.root')
+
+#copy through a temporary name, such that nobody sees a half copied file and an interrupted copy is never used
+def _copy(source,destination):
+    tmpfile = os.path.join(os.path.dirname(destination),'.'+os.path.basename(destination)+'.memo.'+str(os.getpid()))
+    try:
+        shutil.copyfile(source,tmpfile)
+        os.rename(tmpfile,destination)
+    finally:
+        if os.path.exists(tmpfile): os.remove(tmpfile)
+
+#copies the stored output of key to filename, False if there is none
+def fetch_output(store,key,filename):
+    if not os.path.isfile(store_path(store,key)):
+        return False
+    if not os.path.exists(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    _copy(store_path(store,key),filename)
+    return True
+
+#adds the output of a finished job to the store
+def add_output(store,key,filename):
+    path = store_path(store,key)
+    if os.path.exists(path) or not check_FileReadable(filename):
+        return False
+    try:
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        _copy(filename,path)
+    except (IOError,OSError) as e:
+        print 'Could not add',filename,'to the memo store',e
+        return False
+    return True
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Loop used with --loopCheck. Looking at qstat, checking for new files, merging, resubmitting
+# and printing the status are tasks with their own intervals. qstat and qsub are called in worker
+# threads, so a slow qstat does not hold up the merging or the resubmission of jobs. Output files are
+# copied and opened in a worker thread of their own.
+# Only the loop itself changes the JobManagers, the workers just hand back their results.
+# Several workdirs can be watched by one loop, they all share the same qstat snapshot.
+# With --chain complete samples are handed to the next stage (see chain.py), whose workdir is then watched too.
+
+import time
+import threading
+import Queue
+
+from Manager import *
+
+#runs blocking calls one after the other, the callbacks are run by the loop in collect with the result,
+#or with None if the call raised
+class Worker(threading.Thread):
+    def __init__(self,name):
+        threading.Thread.__init__(self,name=name)
+        self.daemon = True
+        self.tasks = Queue.Queue()
+        self.results = Queue.Queue()
+        self.pending = 0
+        self.start()
+
+    def run(self):
+        while True:
+            func, args, callback = self.tasks.get()
+            try:
+                self.results.put((callback,func(*args),None))
+            except Exception as e:
+                self.results.put((callback,None,e))
+
+    def submit(self,func,args,callback):
+        self.pending += 1
+        self.tasks.put((func,args,callback))
+
+    def collect(self):
+        while True:
+            try:
+                callback, result, error = self.results.get_nowait()
+            except Queue.Empty:
+                return
+            self.pending -= 1
+            #the callback is told about a failed call with None, such that it can undo what it started
+            if error:
+                print 'Call in',self.name,'thread failed:',error
+            callback(result)
+
+#calls func every interval seconds
+class PeriodicTask(object):
+    def __init__(self,interval,func):
+        self.interval = interval
+        self.func = func
+        self.lastRun = 0
+
+    def run_if_due(self,now):
+        if now - self.lastRun >= self.interval:
+            self.lastRun = now
+            self.func()
+
+#JobManager together with the cycle it looks after
+class MonitorTarget(object):
+    def __init__(self,manager,OutputDirectory,nameOfCycle,OutputTreeName):
+        self.manager = manager
+        self.OutputDirectory = OutputDirectory
+        self.nameOfCycle = nameOfCycle
+        self.OutputTreeName = OutputTreeName
+        self.chain = None # ChainStage the samples are handed to once they are complete
+
+    #samples that are complete and not handed to the next stage yet
+    def unchained(self):
+        if not self.chain:
+            return []
+        return [process for process in self.manager.subInfo if all(process.jobsDone) and not self.chain.waiting(process.name)]
+
+    #unchained samples that are listed with their entries in Result.xml, the next stage may read it
+    def chain_pending(self):
+        return [process for process in self.unchained() if not self.OutputTreeName or self.manager.entries_written(process)]
+
+#targets for an already submitted workdir, from the information sframe_batch stored there
+def load_targets(options,workdir):
+    targets = []
+    for cycle in read_cycleInfo(workdir):
+        if 'XMLFile' not in cycle:
+            print 'No xml file stored in',workdir,'run sframe_batch on it once more'
+            return []
+        header = fileheader(cycle['XMLFile'])
+        manager = JobManager(options,header,workdir)
+        manager.load_jobs()
+        if not manager.subInfo:
+            print 'No submission information found in',workdir
+            return []
+        targets.append(MonitorTarget(manager,cycle['OutputDirectory'],cycle['Cyclename'].replace('::','.'),cycle['OutputTree']))
+    return targets
+
+class MonitorLoop(object):
+    def __init__(self,targets,qstatInterval=10,checkInterval=5,mergeInterval=10,printInterval=5):
+        self.targets = targets
+        self.qstatWorker = Worker('qstat')
+        self.submitWorker = Worker('qsub')
+        self.fileWorker = Worker('files')
+        self.qstatRunning = False
+        self.printedLines = 0
+        for target in self.targets:
+            self.prepare_target(target)
+        self.tasks = [
+            PeriodicTask(qstatInterval,self.update_watch),
+            PeriodicTask(checkInterval,self.check_files),
+            PeriodicTask(checkInterval,self.advance_chain),
+            PeriodicTask(mergeInterval,self.merge_files),
+            PeriodicTask(printInterval,self.print_status),
+            ]
+
+    def prepare_target(self,target):
+        target.manager.submitter = self.submitWorker.submit
+        target.manager.fileWorker = self.fileWorker.submit
+        target.manager.watchMaxAge = float('inf') # new snapshots only come from the qstat task
+
+    #complete samples are prepared in the next stage by the file worker and submitted by the qsub worker,
+    #its workdir is watched from then on
+    def advance_chain(self):
+        for target in list(self.targets):
+            for process in target.chain_pending():
+                target.chain.inflight.add(process.name)
+                self.fileWorker.submit(target.chain.prepare,(process,target),lambda result, target=target, process=process: self.submit_chained(target,process,result))
+
+    def submit_chained(self,target,process,result):
+        if not result or not result[1]:
+            self.add_chained(target,process,result)
+            return
+        self.submitWorker.submit(target.chain.submit,(result,),lambda result, target=target, process=process: self.add_chained(target,process,result))
+
+    def add_chained(self,target,process,result):
+        newTarget = target.chain.add_chained(process,result)
+        if newTarget:
+            newTarget.manager.watch = target.manager.watch
+            newTarget.manager.watchTime = target.manager.watchTime
+            self.prepare_target(newTarget)
+            self.targets.append(newTarget)
+
+    def update_watch(self):
+        if self.qstatRunning or not any(target.manager.needs_qstat() for target in self.targets):
+            return
+        self.qstatRunning = True
+        self.qstatWorker.submit(self.take_snapshot,(),self.set_watch)
+
+    def take_snapshot(self):
+        try:
+            return pidWatcher()
+        except Exception as e:
+            print 'Could not take a qstat snapshot:',e
+            return None
+
+    def set_watch(self,watch):
+        self.qstatRunning = False
+        if not watch:
+            return
+        for target in self.targets:
+            target.manager.watch = watch
+            target.manager.watchTime = time.time()
+
+    def check_files(self):
+        for target in self.targets:
+            target.manager.check_jobstatus(target.OutputDirectory,target.nameOfCycle)
+
+    def merge_files(self):
+        for target in self.targets:
+            target.manager.merge_files(target.OutputDirectory,target.nameOfCycle,target.OutputTreeName)
+            target.manager.merge.poll()
+
+    def print_status(self):
+        if len(self.targets) == 1:
+            self.targets[0].manager.print_status()
+            return
+        #one table for all workdirs, redrawn in place like the one of a single JobManager
+        lines = []
+        readyFiles = 0
+        totalFiles = 0
+        for target in self.targets:
+            lines.append('--- '+target.manager.workdir+' ('+target.nameOfCycle+')')
+            lines += target.manager.status_lines()
+            readyFiles += target.manager.get_readyFiles()
+            totalFiles += target.manager.totalFiles
+        lines.append('Workdirs: %i Number of files: %i / %i' % (len(self.targets),readyFiles,totalFiles))
+        if self.printedLines:
+            print '\x1b[1A\x1b[2K'*self.printedLines+'\x1b[1A'
+        else:
+            print 'Status of files'
+        for target in self.targets:
+            for item in target.manager.printString:
+                print target.manager.workdir+': '+item
+            target.manager.printString = []
+        for line in lines:
+            print line
+        print '='*80
+        self.printedLines = len(lines)+1
+
+    def finished(self):
+        if self.submitWorker.pending or self.fileWorker.pending:
+            return False
+        if any(target.unchained() for target in self.targets):
+            return False
+        return all(target.manager.is_finished() for target in self.targets)
+
+    def run(self):
+        #the first check has to know about the batch already
+        if not all(target.manager.watch for target in self.targets):
+            self.set_watch(pidWatcher())
+        self.tasks[0].lastRun = time.time()
+        while True:
+            self.qstatWorker.collect()
+            self.submitWorker.collect()
+            self.fileWorker.collect()
+            now = time.time()
+            for task in self.tasks:
+                task.run_if_due(now)
+            if self.finished():
+                #datasets completed by the last check still have to be merged and their entries counted
+                self.merge_files()
+                while self.fileWorker.pending:
+                    time.sleep(0.5)
+                    self.fileWorker.collect()
+                print 'if grid pid information got lost root Files could still be transferring'
+                return
+            time.sleep(0.5)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Every sframe_batch running on a login node needs a qstat snapshot every few seconds.
+# Instead of calling qstat each time, the output of 'qstat -xml' is kept in SNAPSHOT_DIR
+# and used by all sframe_batch of the same user on the host as long as it is younger than SNAPSHOT_TTL.
+# Only one process refreshes it at a time (lock file), the new snapshot replaces the old one atomically.
+# SNAPSHOT_DIR belongs to the user and is only accessible by them (0700). A directory or snapshot
+# that is owned by somebody else or writable by others is not used, qstat is then called directly.
+
+import os
+import time
+import stat
+import fcntl
+import subprocess
+
+SNAPSHOT_TTL = 10 # seconds
+SNAPSHOT_DIR = '/tmp/sframe_batch_qstat_'+str(os.getuid())
+SNAPSHOT_FILE = SNAPSHOT_DIR+'/qstat.xml'
+LOCK_FILE = SNAPSHOT_DIR+'/qstat.lock'
+
+def _call_qstat():
+    proc = subprocess.Popen(['qstat','-xml'],stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    if proc.returncode != 0 or not output:
+        return None
+    return output
+
+#True if the file or directory is ours and nobody else can write to it
+def _trusted(st):
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def _read_fresh():
+    try:
+        fd = os.open(SNAPSHOT_FILE,os.O_RDONLY|os.O_NOFOLLOW)
+    except OSError:
+        return None
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or not _trusted(st) or time.time() - st.st_mtime >= SNAPSHOT_TTL:
+            return None
+        with os.fdopen(os.dup(fd)) as f:
+            return f.read()
+    except (IOError,OSError):
+        return None
+    finally:
+        os.close(fd)
+
+#raises OSError if the directory can not be made or is not safe to use
+def _prepare_dir():
+    try:
+        os.mkdir(SNAPSHOT_DIR,0700)
+    except OSError:
+        pass # already there, checked below
+    st = os.lstat(SNAPSHOT_DIR)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 077:
+        raise OSError('%s is not a directory of this user with mode 0700' % SNAPSHOT_DIR)
+
+#xml output of qstat for the jobs of this user, None if qstat did not work
+def qstat_snapshot():
+    snapshot = _read_fresh()
+    if snapshot:
+        return snapshot
+    try:
+        _prepare_dir()
+        lock = os.open(LOCK_FILE,os.O_RDWR|os.O_CREAT|os.O_NOFOLLOW,0600)
+    except (IOError,OSError) as e:
+        print 'Could not use the shared qstat snapshot in',SNAPSHOT_DIR,e
+        return _call_qstat()
+    try:
+        fcntl.flock(lock,fcntl.LOCK_EX)
+        # somebody else might have refreshed it while we were waiting for the lock
+        snapshot = _read_fresh()
+        if snapshot:
+            return snapshot
+        snapshot = _call_qstat()
+        if not snapshot:
+            return None
+        tmpfile = SNAPSHOT_FILE+'.'+str(os.getpid())
+        try:
+            fd = os.open(tmpfile,os.O_WRONLY|os.O_CREAT|os.O_EXCL|os.O_NOFOLLOW,0600)
+            with os.fdopen(fd,'w') as f:
+                f.write(snapshot)
+            os.rename(tmpfile,SNAPSHOT_FILE)
+        except (IOError,OSError) as e:
+            print 'Could not store the qstat snapshot in',SNAPSHOT_DIR,e
+        return snapshot
+    finally:
+        fcntl.flock(lock,fcntl.LOCK_UN)
+        os.close(lock)
@@ -6,8 +6,7 @@
 
 
 
-import sys, multiprocessing, time
-from ROOT import *
+import sys, os, multiprocessing, time
 
 def read_xml(xmlFileDir):
     xmlFile = open(str(xmlFileDir))
@@ -30,6 +29,7 @@ def write_xml_entry_tag(xmlFile,result,fast):
     xmlFile.write('<!-- < NumberEntries="'+str(result)+'" Method='+method+' /> -->')
 
 def read_tree(rootDir):
+    from ROOT import TFile
     numberOfweightedEntries = 0 
     try:
         ntuple = TFile(str(rootDir))
@@ -44,6 +44,7 @@ def read_tree(rootDir):
     return numberOfweightedEntries
 
 def read_treeFast(rootDir):
+    from ROOT import TFile
     fastentries =0
     try:
         ntuple = TFile(str(rootDir))
@@ -54,35 +55,67 @@ def read_treeFast(rootDir):
         print e
     return fastentries
 
-def readEntries(worker, xmlfiles, fast=False):
+def count_file(task):
+    rootfile, fast = task
+    if fast:
+        return task, read_treeFast(rootfile)
+    return task, read_tree(rootfile)
+
+#results of files that were already counted, one line per file: method, entries, file
+def read_checkpoint(checkpoint):
+    done = {}
+    if not checkpoint or not os.path.exists(checkpoint):
+        return done
+    for line in open(checkpoint):
+        fields = line.rstrip('\n').split('\t')
+        if len(fields) != 3: continue # interrupted while writing
+        fast = fields[0] == 'fast'
+        done[(fields[2],fast)] = int(fields[1]) if fast else float(fields[1])
+    return done
+
+#Counts the entries of all root files of several xml files with one pool, samples is a list of (xml file, fast).
+#Each result is added to the checkpoint file as soon as it is there, so an interrupted count goes on from there.
+def count_entries(worker, samples, checkpoint=None):
+    done = read_checkpoint(checkpoint)
+    rootFiles = {}
+    tasks = []
+    for xml, fast in samples:
+        if (xml,fast) in rootFiles: continue
+        print "open XML file:",xml
+        rootFiles[(xml,fast)] = read_xml(xml)
+        for rootfile in rootFiles[(xml,fast)]:
+            if (rootfile,fast) not in done:
+                tasks.append((rootfile,fast))
+    tasks = list(set(tasks))
+    if tasks:
+        print "counting",len(tasks),"files with",worker,"workers,",len(done),"files counted before"
+        checkpointFile = open(checkpoint,'a') if checkpoint else None
+        pool = multiprocessing.Pool(processes=int(worker))
+        try:
+            lastPrint = time.time()
+            for number, (task, entries) in enumerate(pool.imap_unordered(count_file,tasks)):
+                done[task] = entries
+                if checkpointFile:
+                    checkpointFile.write(('fast' if task[1] else 'weights')+'\t'+repr(entries)+'\t'+task[0]+'\n')
+                    checkpointFile.flush()
+                if time.time() - lastPrint > 10:
+                    print "Missing [%]", round(100*(1-float(number+1)/len(tasks)))
+                    lastPrint = time.time()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            if checkpointFile: checkpointFile.close()
+    return [sum(done[(rootfile,fast)] for rootfile in rootFiles[(xml,fast)]) for xml, fast in samples]
+
+def readEntries(worker, xmlfiles, fast=False, checkpoint=None):
     if fast: print 'Going to use the Fast Method, no weights used'
     print "number of workers",worker
-    sum_list =[]
-    for xml in xmlfiles:
-        pool = multiprocessing.Pool(processes=int(worker))
-        print "open XML file:",xml
-        rootFileStore = read_xml(xml)
-        numberXMLFiles = len(rootFileStore)
-        result = None
-        if(fast):
-            result = pool.map_async(read_treeFast,rootFileStore)
-        else:
-            result = pool.map_async(read_tree,rootFileStore)
-        
-        print result._number_left ,numberXMLFiles,result._chunksize
-        while result._number_left>0:
-            sys.stdout.write("\033[F")
-            #print result._number_left ,numberXMLFiles,result._chunksize
-            missing = round(float(result._number_left)*float(result._chunksize)/float(numberXMLFiles)*100)
-            if(missing > 100):
-                missing =100
-            print "Missing [%]", missing
-            time.sleep(10)
-        pool.close()
-        pool.join()
-        xml_result = sum(result.get())
+    sum_list = count_entries(worker,[(xml,fast) for xml in xmlfiles],checkpoint)
+    for xml, xml_result in zip(xmlfiles,sum_list):
         print "number of events in",xml,xml_result
-        sum_list.append(xml_result)
         write_xml_entry_tag(xml,xml_result, fast)
     return sum_list
         
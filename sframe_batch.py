@@ -13,8 +13,12 @@ import timeit
 import StringIO
 import subprocess
 #import multiprocessing
+from multiprocessing.pool import ThreadPool
 from Manager import *
+from monitor import *
 from LumiCalcAutoBuilder import *
+from chain import load_chain, shared_workdir
+from input_check import check_inputs
 
 def SFrameBatchMain(input_options):
     parser = OptionParser(usage="usage: %prog [options] filename",
@@ -34,6 +38,16 @@ def SFrameBatchMain(input_options):
                       dest="submit",
                       default=False,
                       help="Submit Jobs to the grid")
+    parser.add_option("--pipeline",
+                      action="store_true",
+                      dest="pipeline",
+                      default=False,
+                      help="Together with -s: submit the jobs of each sample as soon as its xml files are written, while the next samples are still prepared.")
+    parser.add_option("--checkInputs",
+                      action="store_true",
+                      dest="checkInputs",
+                      default=False,
+                      help="Check before the jobs are made that every input file is there, can be read and is not only on tape. Bad files are left out and listed in bad_inputs.txt in the workdir.")
     parser.add_option("-r", "--resubmit",
                       action="store_true", # optional because action defaults to "store"
                       dest="resubmit",
@@ -80,6 +94,18 @@ def SFrameBatchMain(input_options):
                       default=[],
                       help="Replace Items in UserConfig, for more then one just add as many times the command as you need. Nice for uncertainties. Usage --ReplaceUserItem \"Name,Value\""
                       )
+    parser.add_option("--Variation",
+                      action="append",
+                      dest="variations",
+                      default=[],
+                      help="Run a variation of the UserConfig instead of the nominal one, add it as many times as you need. Every variation gets its own workdir (workdir.Name_Value) and output directory (OutputDirectory/Name_Value/). The splitting into jobs is done only once for all of them and they are submitted in parallel. Usage --Variation \"Name,Value\""
+                      )
+    parser.add_option("--chain",
+                      action="append",
+                      dest="chain",
+                      default=[],
+                      help="Config xml file of the next stage, reading the output of this one. Add it once per stage in the order they run. Needs -l, every sample is prepared and submitted in the next stage as soon as all its files are there. Usage --chain NextStage.xml"
+                      )
     parser.add_option("--addTree",
                       action="append",
                       dest="sframeTreeInfo",
@@ -91,6 +117,12 @@ def SFrameBatchMain(input_options):
                       dest="FileSplitFileCheck",
                       help="Force to remove empty files in FileSplit mode. This is only necessary after a Selection where there many Files with no entries at all or only very few. This might lead to sframe crashing."
                       )
+    parser.add_option("--status",
+                      action="store_true",
+                      dest="status",
+                      default=False,
+                      help="Only print the status of an already existing workdir. The xml file is not parsed again and nothing is submitted."
+                      )
     parser.add_option("--XMLDatabase",
                       action="store",
                       dest="xmldatabaseDir",
@@ -105,6 +137,8 @@ def SFrameBatchMain(input_options):
     #global header
     if len(args) != 1:
         parser.error("wrong number of arguments. Help can be invoked with --help")
+    if options.chain and not options.loop:
+        parser.error("--chain needs --loopCheck")
 
     xmlfile = args[0]
     if options.xmldatabaseDir:
@@ -123,11 +157,6 @@ def SFrameBatchMain(input_options):
     if not os.path.exists('JobConfig.dtd'):
         os.system('ln -sf %s/JobConfig.dtd .' % scriptpath)
 
-    #print xmlfile, os.getcwd
-    proc_xmllint = subprocess.Popen(['xmllint','--noent',xmlfile],stdout=subprocess.PIPE)
-    xmlfile_strio = StringIO.StringIO(proc_xmllint.communicate()[0])
-    sax_parser = xml.sax.make_parser()
-    xmlparsed = parse(xmlfile_strio,sax_parser)
     header = fileheader(xmlfile)
     if options.FileSplitFileCheck:
         header.RemoveEmptyFileSplit = True
@@ -136,21 +165,35 @@ def SFrameBatchMain(input_options):
     if header.RemoveEmptyFileSplit and header.FileSplit:
         print "Removing all empty files in FileSplit mode."
 
-    node = xmlparsed.getElementsByTagName('JobConfiguration')[0]
-    Job = JobConfig(node)
-    
     workdir = header.Workdir
     if options.workdir:
         print "Overwriting workdir:",workdir,"with",options.workdir
         workdir = options.workdir
     if not workdir : workdir="workdir"
+    if options.chain:
+        sharedWorkdir = shared_workdir(workdir,options.chain)
+        if sharedWorkdir:
+            parser.error("the stages of --chain need workdirs of their own, "+sharedWorkdir+" is used twice")
     #if not workdir.endswith("/"): workdir += "/" 
+
+    if options.status:
+        status = SFrameBatchStatus(options,header,workdir)
+        stop = timeit.default_timer()
+        print "SFrame Batch was running for",round(stop - start,2),"sec"
+        return status
+
     currentDir = os.getcwd()
     if not os.path.exists(workdir+'/'):
         os.makedirs(workdir+'/')
         print workdir,'has been created'
         shutil.copy(scriptpath+"JobConfig.dtd",workdir)
         shutil.copy(args[0],workdir)
+
+    #print xmlfile, os.getcwd
+    Job = load_jobconfig_cache(xmlfile,header,workdir)
+    if not Job:
+        Job = parse_jobconfig(xmlfile)
+        save_jobconfig_cache(Job,xmlfile,header,workdir)
     #print header.Version[0]
 
     for cycle in Job.Job_Cylce:
@@ -174,43 +217,65 @@ def SFrameBatchMain(input_options):
                         if item_name == cycle_item.Name:
                             print "Replacing",item_name,"Value:",cycle_item.Value ,"with",item_value
                             cycle_item.Value = item_value
+    write_cycleInfo(workdir,Job.Job_Cylce,xmlfile)
+    if options.checkInputs: check_inputs(Job,workdir)
+
+    if options.variations:
+        status = SFrameBatchVariations(options,header,workdir,Job,xmlfile,scriptpath)
+        stop = timeit.default_timer()
+        print "SFrame Batch was running for",round(stop - start,2),"sec"
+        return status
+
+    managers = [] # of all cycles and chained stages, sframe_batch fails if one of them did not finish
+    for cycle in Job.Job_Cylce:
         print 'starting manager'
         manager = JobManager(options,header,workdir)
-        manager.process_jobs(cycle.Cycle_InputData,Job)
+        managers.append(manager)
+        if options.submit and options.pipeline:
+            #qsub is called in its own thread, one sample after the other, while the next ones are prepared
+            pool = ThreadPool(1)
+            submissions = []
+            manager.process_jobs(cycle.Cycle_InputData,Job,prepared=lambda process: submissions.append(pool.apply_async(manager.submit_process,(process,))))
+            pool.close()
+            pool.join()
+            for submission in submissions: submission.get()
+        else:
+            manager.process_jobs(cycle.Cycle_InputData,Job)
         nameOfCycle = cycle.Cyclename.replace('::','.')
+        OutputTreeName = output_tree_name(cycle.Cycle_InputData)
         #this small function creates a xml file with the expected files 
         if result_info(Job, workdir, header,options.sframeTreeInfo) == 1: 
             print ' Result.xml created for further jobs'
         #submit jobs if asked for
-        if options.submit: manager.submit_jobs(cycle.OutputDirectory,nameOfCycle)
+        if options.submit and not options.pipeline: manager.submit_jobs(cycle.OutputDirectory,nameOfCycle)
         manager.check_jobstatus(cycle.OutputDirectory, nameOfCycle,False,False)
         if options.resubmit: manager.resubmit_jobs()
         #get once into the loop for resubmission & merging
 
         if not options.loop and options.forceMerge and not options.waitMerge:
             manager.check_jobstatus(cycle.OutputDirectory,nameOfCycle)
-            manager.merge_files(cycle.OutputDirectory,nameOfCycle,cycle.Cycle_InputData)
+            manager.merge_files(cycle.OutputDirectory,nameOfCycle,OutputTreeName)
             return 0
 
         
-        loop_check = True 
-        while loop_check==True:   
-            if not options.loop:
-                loop_check = False
-                # This is necessary since qstat sometimes does not find the jobs it should monitor.
-                # So it checks that it does not find the job 5 times before auto resubmiting it.
-                for i in range(6):
-                    manager.check_jobstatus(cycle.OutputDirectory,nameOfCycle)       
-            else:
-                manager.check_jobstatus(cycle.OutputDirectory,nameOfCycle)
-               
-            manager.merge_files(cycle.OutputDirectory,nameOfCycle,cycle.Cycle_InputData)
-            if manager.get_subInfoFinish() or (not manager.merge.get_mergerStatus() and manager.missingFiles==0):
+        if options.loop:
+            targets = [MonitorTarget(manager,cycle.OutputDirectory,nameOfCycle,OutputTreeName)]
+            if options.chain:
+                stages = load_chain(options,options.chain,scriptpath)
+                targets[0].chain = stages[0]
+                targets += [stage.target for stage in stages if stage.target]
+            MonitorLoop(targets).run()
+            for target in targets[1:]:
+                managers.append(target.manager)
+                target.manager.merge_wait()
+                target.manager.print_status()
+        else:
+            # qstat sometimes does not find the jobs it should monitor, so a job is only auto resubmitted
+            # once it was missing for NotFoundTimeout seconds, possibly over several calls of sframe_batch.
+            manager.check_jobstatus(cycle.OutputDirectory,nameOfCycle)
+            manager.merge_files(cycle.OutputDirectory,nameOfCycle,OutputTreeName)
+            if manager.is_finished():
                 print 'if grid pid information got lost root Files could still be transferring'
-                break
-            if options.loop: 
-                manager.print_status()
-                time.sleep(5)
         #print 'Total progress', tot_prog
         manager.merge_wait()
         manager.check_jobstatus(cycle.OutputDirectory,nameOfCycle,False,False)
@@ -220,7 +285,97 @@ def SFrameBatchMain(input_options):
     print "SFrame Batch was running for",round(stop - start,2),"sec"
     #exit gracefully
 
-    if all(si.status == 1 for si in manager.subInfo):
+    if all(si.status == 1 for manager in managers for si in manager.subInfo):
+        return 0
+    else:
+        return -1
+
+
+#one workdir per --Variation, the jobs are planned once and the xml files written for each variation
+def SFrameBatchVariations(options,header,workdir,Job,xmlfile,scriptpath):
+    plans = {}
+    targets = []
+    for cycle in Job.Job_Cylce:
+        nameOfCycle = cycle.Cyclename.replace('::','.')
+        OutputTreeName = output_tree_name(cycle.Cycle_InputData)
+        OutputDirectory = cycle.OutputDirectory
+        if not OutputDirectory.endswith('/'): OutputDirectory += '/'
+        for variation in options.variations:
+            if ',' not in variation:
+                print 'No , found in the variation:',variation
+                continue
+            item_name, item_value = variation.split(',')[:2]
+            items = [item for item in cycle.Cycle_UserConf if item.Name == item_name]
+            if not items:
+                print 'No UserConfig item',item_name,'in',cycle.Cyclename,'skipping the variation'
+                continue
+            nominal = [item.Value for item in items]
+            for item in items:
+                item.Value = item_value
+            varWorkdir = workdir+'.'+item_name+'_'+item_value
+            cycle.OutputDirectory = OutputDirectory+item_name+'_'+item_value+'/'
+            print 'Variation',item_name,item_value,'in',varWorkdir
+            if not os.path.exists(varWorkdir+'/'):
+                os.makedirs(varWorkdir+'/')
+                shutil.copy(scriptpath+"JobConfig.dtd",varWorkdir)
+                shutil.copy(xmlfile,varWorkdir)
+            manager = JobManager(options,header,varWorkdir)
+            manager.process_jobs(cycle.Cycle_InputData,Job,plans)
+            if result_info(Job, varWorkdir, header,options.sframeTreeInfo) == 1: 
+                print ' Result.xml created for further jobs'
+            write_cycleInfo(varWorkdir,[cycle],xmlfile)
+            targets.append(MonitorTarget(manager,cycle.OutputDirectory,nameOfCycle,OutputTreeName))
+            for item,value in zip(items,nominal):
+                item.Value = value
+        cycle.OutputDirectory = OutputDirectory
+    if not targets:
+        return -1
+
+    #qsub of the different variations is done in parallel
+    if options.submit:
+        pool = ThreadPool(len(targets))
+        pool.map(lambda target: target.manager.submit_jobs(target.OutputDirectory,target.nameOfCycle),targets)
+        pool.close()
+    for target in targets:
+        target.manager.check_jobstatus(target.OutputDirectory,target.nameOfCycle,False,False)
+        if options.resubmit: target.manager.resubmit_jobs()
+
+    if options.loop:
+        loop = MonitorLoop(targets)
+        loop.run()
+    else:
+        for target in targets:
+            target.manager.check_jobstatus(target.OutputDirectory,target.nameOfCycle)
+            target.manager.merge_files(target.OutputDirectory,target.nameOfCycle,target.OutputTreeName)
+    for target in targets:
+        target.manager.merge_wait()
+        target.manager.check_jobstatus(target.OutputDirectory,target.nameOfCycle,False,False)
+        print '-'*80
+        print target.manager.workdir
+        target.manager.print_status()
+
+    if all(si.status == 1 for target in targets for si in target.manager.subInfo):
+        return 0
+    else:
+        return -1
+
+#status of an existing workdir, only the saved submission information is used
+def SFrameBatchStatus(options,header,workdir):
+    cycles = read_cycleInfo(workdir)
+    if not cycles:
+        print 'No submission information found in',workdir
+        return -1
+    managers = []
+    for cycle in cycles:
+        manager = JobManager(options,header,workdir)
+        manager.load_jobs()
+        if not manager.subInfo:
+            print 'No submission information found in',workdir
+            return -1
+        manager.check_jobstatus(cycle['OutputDirectory'],cycle['Cyclename'].replace('::','.'),False,False)
+        manager.print_status()
+        managers.append(manager)
+    if all(si.status == 1 for manager in managers for si in manager.subInfo):
         return 0
     else:
         return -1
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Watches several workdirs that were submitted with sframe_batch.py (without -l) in one process.
+# Only one qstat is done per cycle for all of them, finished samples are merged like with -l.
+# Has to be started from the directory sframe_batch.py was run in, the workdirs are relative to it.
+
+from optparse import OptionParser
+
+import sys
+import timeit
+from monitor import *
+
+def SFrameMonitorMain(input_options):
+    parser = OptionParser(usage="usage: %prog [options] workdir [workdir ...]",
+                          version="%prog 0.1")
+    parser.add_option("-a", "--addFiles",
+                      action="store_true",
+                      dest="add",
+                      default=False,
+                      help="hadd files to one")
+    parser.add_option("-T", "--addFilesNoTree",
+                      action="store_true",
+                      dest="addNoTree",
+                      default=False,
+                      help="hadd files to one, without merging TTrees.")
+    parser.add_option("-c", "--continueMerge",
+                      action="store_true",
+                      dest="waitMerge",
+                      default=False,
+                      help="Wait for all merging subprocess to finish before exiting program.")
+    parser.add_option("-k", "--keepGoing",
+                      action="store_true",
+                      dest="keepGoing",
+                      default=False,
+                      help="Never ask for user input, but keep going on.")
+    parser.add_option("-x", "--exitOnQuestion",
+                      action="store_true",
+                      dest="exitOnQuestion",
+                      default=False,
+                      help="Never ask for user input, but exit instead. (Overwrites keepGoing)")
+    parser.add_option("--qstatInterval",
+                      action="store",
+                      type="float",
+                      dest="qstatInterval",
+                      default=10,
+                      help="Seconds between two qstat calls, shared by all workdirs.")
+    parser.set_defaults(forceMerge=False)
+
+    (options, args) = parser.parse_args(input_options)
+
+    start = timeit.default_timer()
+    if len(args) < 1:
+        parser.error("no workdir given. Help can be invoked with --help")
+
+    targets = []
+    for workdir in args:
+        workdirTargets = load_targets(options,workdir)
+        if not workdirTargets:
+            print 'Skipping',workdir
+        targets += workdirTargets
+    if not targets:
+        return -1
+
+    loop = MonitorLoop(targets,qstatInterval=options.qstatInterval)
+    loop.run()
+    for target in targets:
+        target.manager.merge_wait()
+    loop.print_status()
+    stop = timeit.default_timer()
+    print "SFrame Monitor was running for",round(stop - start,2),"sec"
+
+    if all(si.status == 1 for target in targets for si in target.manager.subInfo):
+        return 0
+    else:
+        return -1
+
+
+if __name__ == "__main__":
+    status = SFrameMonitorMain(sys.argv[1:])
+    exit(status)
@@ -1,10 +1,20 @@
 #!/usr/bin/env python
 
-import ROOT
 import sys
-from glob import glob
+from glob_cache import cached_glob
+
+#ROOT is imported only where files are opened, importing it takes several seconds. Files are opened from
+#the threads of the monitor loop as well, so ROOT is told once to protect its global state.
+def load_ROOT():
+     import ROOT
+     if not getattr(load_ROOT,'threadSafe',False):
+          if hasattr(ROOT,'EnableThreadSafety'):
+               ROOT.EnableThreadSafety()
+          load_ROOT.threadSafe = True
+     return ROOT
 
 def check_TreeExists(filename,treename):
+     ROOT = load_ROOT()
      rootfile = ROOT.TFile.Open(filename)
      #print filename
      try:
@@ -19,11 +29,35 @@ def check_TreeExists(filename,treename):
      #if rootTree: return False
      #return True
 
+#root file that can be opened and was closed properly by the job that wrote it
+def check_FileReadable(filename):
+     ROOT = load_ROOT()
+     rootfile = ROOT.TFile.Open(filename)
+     if not rootfile or rootfile.IsZombie() or rootfile.TestBit(ROOT.TFile.kRecovered):
+          return False
+     rootfile.Close()
+     return True
+
+#number of entries of the tree in the file, -1 if the file can not be read
+def count_Entries(filename,treename):
+     ROOT = load_ROOT()
+     rootfile = ROOT.TFile.Open(filename)
+     if not rootfile or rootfile.IsZombie() or rootfile.TestBit(ROOT.TFile.kRecovered):
+          return -1
+     rootTree = rootfile.Get(treename)
+     entries = rootTree.GetEntries() if rootTree else 0
+     rootfile.Close()
+     return entries
+
+#entries of the tree in each of the files
+def count_files(filenames,treename):
+     return [count_Entries(filename,treename) for filename in filenames]
+
 
 if __name__ == "__main__":
      for arg in sys.argv[2:]:
           if '*' in arg:
-               for itfile in glob(pattern):
+               for itfile in cached_glob(arg):
                      check_TreeExists(itfile,sys.argv[1])
           else:
                check_TreeExists(arg,sys.argv[1])